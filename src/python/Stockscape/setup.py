@@ -20,4 +20,11 @@ setup(name='stockscape',
           'future',
           'six'
       ],
-      zip_safe=True)
+      extras_require={
+          'dsr': ['seaborn', 'statsmodels'],
+          'jit': ['numba']
+      },
+      entry_points={
+          'console_scripts': ['stockscape=stockscape.cli:main']
+      },
+      zip_safe=False)
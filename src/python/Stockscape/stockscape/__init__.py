@@ -1,9 +1,40 @@
 """Package for analyzing stock returns using the CAPE framework from Robert Shiller."""
 
-from .reader import read_ie_data
-from .returns import BondHoldToMaturityReturns, Inflation, StockReturns, WaitingReturns
-from .analysis import Cape, CapeNeighborsEstimator, WarrantedReturns
-from .ui import UiData
+import importlib
+
+# The public names are imported on first use, so tools like the command-line build
+# can check their caches without paying for importing pandas and scipy.
+_EXPORTS = {
+    'read_ie_data': 'reader',
+    'BondHoldToMaturityReturns': 'returns',
+    'BondTotalReturns': 'returns',
+    'Inflation': 'returns',
+    'StockReturns': 'returns',
+    'WaitingReturns': 'returns',
+    'Cape': 'analysis',
+    'CapeNeighborsEstimator': 'analysis',
+    'CapeNeighborsWalkForward': 'analysis',
+    'WarrantedReturns': 'analysis',
+    'UiData': 'ui',
+    'read_snapshot': 'snapshot',
+    'write_snapshot': 'snapshot',
+    'PercentileIndex': 'percentiles',
+    'CapeNeighborsTuner': 'tuning',
+}
+
+__all__ = sorted(_EXPORTS)
 
 __author__ = 'Chandrasekhar Ramakrishnan <ciyer@illposed.com>'
 __version__ = '0.9.1'
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
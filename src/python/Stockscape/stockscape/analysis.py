@@ -10,10 +10,14 @@ Created by Chandrasekhar Ramakrishnan on 2017-06-30.
 Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
+import bisect
+
 import numpy as np
 import pandas as pd
 from scipy import stats as st
 
+from . import kernels
+
 
 class Cape(object):
     """Compute the CAPE (Cyclically-Adjusted Price/Earnings ratio)"""
@@ -44,10 +48,9 @@ class Cape(object):
         df = real_stock_data.df
         months = years * 12
         # Use the past months of earnings but do not include the current month in the CAPE calculation.
-        if summary == 'mean':
-            earnings = df.rolling(months, 1).mean()['earnings'].shift(1)
-        else:
-            earnings = df.rolling(months, 1).median()['earnings'].shift(1)
+        summary = 'mean' if summary == 'mean' else 'median'
+        earnings = pd.Series(kernels.rolling_summary(df['earnings'].values, months, summary), index=df.index)
+        earnings = earnings.shift(1)
         earnings = earnings.drop(earnings.index[0:months])
 
         df = df.assign(cape=df['price'] / earnings)
@@ -175,9 +178,11 @@ class CapeNeighborsPredictor(object):
 
         # Drop columns I need to predict from the data used to predict
         diff_mtx = cape_diff_df.drop(template_df.index, axis=1)
+        distances = np.abs(diff_mtx.loc[template_df.index].values)
+        nearest_positions = kernels.smallest_k(distances, max_neighbors)
 
-        for d in template_df.index:
-            nearest = np.abs(diff_mtx.loc[d]).sort_values()[0:max_neighbors]
+        for d, row, positions in zip(template_df.index, distances, nearest_positions):
+            nearest = pd.Series(row[positions], index=diff_mtx.columns[positions], name=d)
             nearest_dates_dict[d.to_datetime64()] = nearest
 
         return nearest_dates_dict
@@ -225,3 +230,212 @@ class CapeNeighborsPredictor(object):
             return pd.Series(results, ['min', 'ci_min', result_col_name, 'ci_max', 'max'], np.float64)
 
         return predict
+
+
+class SortedPool(object):
+    """(key, value) pairs sorted by key, stored in blocks of at most 2 * block_size pairs.
+
+    An insert is a binary search over the block maxima and one within a block, and only shifts the entries of
+    that block, so n inserts cost O(n sqrt(n)) at worst instead of the O(n^2) of a single sorted list.
+    """
+
+    def __init__(self, block_size=512):
+        self.block_size = block_size
+        self.keys = []
+        self.values = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, key, value):
+        """Insert the pair after any pairs with an equal key."""
+        self.size += 1
+        if not self.maxes:
+            self.keys.append([key])
+            self.values.append([value])
+            self.maxes.append(key)
+            return
+        # The first block with a larger maximum, or the last block
+        b = min(bisect.bisect_right(self.maxes, key), len(self.maxes) - 1)
+        keys, values = self.keys[b], self.values[b]
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        values.insert(i, value)
+        self.maxes[b] = keys[-1]
+        if len(keys) > 2 * self.block_size:
+            half = len(keys) // 2
+            self.keys[b:b + 1] = [keys[0:half], keys[half:]]
+            self.values[b:b + 1] = [values[0:half], values[half:]]
+            self.maxes[b:b + 1] = [keys[half - 1], keys[-1]]
+
+    def nearest(self, key, count):
+        """Return the values of the count pairs with keys nearest to key, closest first.
+
+        Of two pairs at the same distance, the one with the smaller key comes first.
+        """
+        result = []
+        if not self.maxes:
+            return result
+        # Cursors (block, position) on the first pair >= key and the pair before it
+        hb = bisect.bisect_left(self.maxes, key)
+        if hb == len(self.maxes):
+            hb, hi = hb - 1, len(self.keys[hb - 1])
+        else:
+            hi = bisect.bisect_left(self.keys[hb], key)
+        lb, lo = hb, hi - 1
+        if lo < 0 and lb > 0:
+            lb -= 1
+            lo = len(self.keys[lb]) - 1
+        for _ in range(min(count, self.size)):
+            has_hi = hi < len(self.keys[hb])
+            if lo >= 0 and (not has_hi or key - self.keys[lb][lo] <= self.keys[hb][hi] - key):
+                result.append(self.values[lb][lo])
+                lo -= 1
+                if lo < 0 and lb > 0:
+                    lb -= 1
+                    lo = len(self.keys[lb]) - 1
+            else:
+                result.append(self.values[hb][hi])
+                hi += 1
+                if hi == len(self.keys[hb]) and hb + 1 < len(self.keys):
+                    hb += 1
+                    hi = 0
+        return result
+
+
+class CapeNeighborsWalkForward(object):
+    """Out-of-sample, point-in-time predictions from CAPE-neighbors.
+
+    For each date t, the neighbors are drawn only from dates whose values were already known at t, that is,
+    dates s with s + months <= t. Instead of a difference matrix, the neighbor pool is kept as a SortedPool of
+    (CAPE, value) pairs that grows as values become known, so each date costs a binary search plus a walk over
+    max_neighbors entries, and adding a value to the pool is O(sqrt(n)). This keeps long daily series tractable.
+    """
+
+    def __init__(self, cape, df, column, months, max_neighbors=20):
+        """
+        :param cape: A Cape object used for determining neighbors.
+        :param df: The frame (indexed by date) with the values to predict.
+        :param column: The column we want to predict
+        :param months: The number of months after its date at which a value becomes known (e.g., the return period)
+        :param max_neighbors: The maxiumum number of neighbors that will be used
+        """
+        self.cape = cape
+        self.source_df = df
+        self.column = column
+        self.months = months
+        self.max_neighbors = max_neighbors
+        self.cape_ser = cape.df['cape'].dropna()
+        self.realized = df[column].reindex(self.cape_ser.index)
+        self.neighbors = self.compute_neighbors(self.cape_ser, self.realized, months, max_neighbors)
+
+    @staticmethod
+    def compute_neighbors(cape_ser, realized, months, max_neighbors):
+        """Compute, for each date, the values of the nearest neighbors known at that date.
+
+        :param cape_ser: A series of CAPE values, indexed by date
+        :param realized: A series of values to predict, indexed like cape_ser
+        :param months: The number of months after its date at which a value becomes known
+        :param max_neighbors: The maximum number of neighbors
+        :return: An array (dates x max_neighbors) of neighbor values ordered by distance, padded with nan
+        """
+        capes = cape_ser.values
+        values = realized.values
+        # The position of the first date at which the value for each date is known
+        known_dates = cape_ser.index + pd.DateOffset(months=months)
+        known_at = np.searchsorted(cape_ser.index.values, known_dates.values)
+        pending = np.argsort(known_at, kind='mergesort')
+
+        pool = SortedPool()
+        neighbors = np.full((len(capes), max_neighbors), np.nan)
+        next_pending = 0
+        for t in range(len(capes)):
+            while next_pending < len(pending) and known_at[pending[next_pending]] <= t:
+                s = pending[next_pending]
+                next_pending += 1
+                if np.isnan(values[s]):
+                    continue
+                pool.insert(capes[s], values[s])
+            nearest = pool.nearest(capes[t], max_neighbors)
+            neighbors[t, 0:len(nearest)] = nearest
+        return neighbors
+
+    def summarize(self, neighbor_count):
+        """Return a frame with min, ci_min, mean, ci_max, max of the nearest neighbor_count neighbors.
+
+        Dates with fewer than neighbor_count known neighbors are nan.
+        """
+        neighbors = self.neighbors[:, 0:neighbor_count]
+        complete = ~np.isnan(neighbors).any(axis=1)
+        neighbors = neighbors[complete]
+        mean = neighbors.mean(axis=1)
+        if neighbor_count > 1:
+            half_width = st.t.ppf(0.975, neighbor_count - 1) * st.sem(neighbors, axis=1)
+        else:
+            half_width = np.full(len(mean), np.nan)
+        summary = pd.DataFrame(np.nan, index=self.cape_ser.index, columns=['min', 'ci_min', 'mean', 'ci_max', 'max'])
+        summary.loc[complete] = np.column_stack(
+            [neighbors.min(axis=1), mean - half_width, mean, mean + half_width, neighbors.max(axis=1)])
+        return summary
+
+    def predict(self, number_of_neighbors=None, transform=None, result_col_name=None):
+        """Compute a frame with point-in-time predictions.
+
+        Columns are grouped by number of neighbors used. For each group:
+            min, ci_min, returns, ci_max, max.
+
+        :param number_of_neighbors: An array with the number of neighbors, defaults to just [self.max_neighbors]
+        :param transform: An optional transform applied to the result values
+        :param result_col_name: The name of the results column, defaults to self.column
+        :return: A data frame with the predicted values
+        """
+        number_of_neighbors = self._neighbor_counts(number_of_neighbors)
+        if not result_col_name:
+            result_col_name = self.column
+        estimates = []
+        apply_multiindex = len(number_of_neighbors) > 1
+        for nc in number_of_neighbors:
+            estimate = self.summarize(nc)
+            if transform:
+                estimate = estimate.apply(lambda col: pd.Series(transform(col.values), col.index))
+            estimate.columns = ['min', 'ci_min', result_col_name, 'ci_max', 'max']
+            if apply_multiindex:
+                estimate.columns = pd.MultiIndex.from_product([[nc], estimate.columns], names=['neighbors', 'stat'])
+            estimates.append(estimate)
+
+        return pd.concat(estimates, axis=1).sort_index(axis=1)
+
+    def error_stats(self, number_of_neighbors=None, transform=None):
+        """Compute statistics of the forecast error (forecast - realized) for each number of neighbors.
+
+        :param number_of_neighbors: An array with the number of neighbors, defaults to just [self.max_neighbors]
+        :param transform: An optional transform applied to forecasts and realized values before comparing them
+        :return: A frame indexed by number of neighbors with columns count, mean_error, mae, rmse, ci_coverage
+        """
+        number_of_neighbors = self._neighbor_counts(number_of_neighbors)
+        realized = self.realized.values
+        if transform:
+            realized = transform(realized)
+        rows = []
+        for nc in number_of_neighbors:
+            summary = self.summarize(nc)
+            if transform:
+                summary = summary.apply(lambda col: pd.Series(transform(col.values), col.index))
+            valid = ~(np.isnan(realized) | summary['mean'].isnull().values)
+            error = summary['mean'].values[valid] - realized[valid]
+            covered = (summary['ci_min'].values[valid] <= realized[valid]) & \
+                      (realized[valid] <= summary['ci_max'].values[valid])
+            coverage = covered.mean() if nc > 1 else np.nan
+            rows.append([valid.sum(), error.mean(), np.abs(error).mean(), np.sqrt(np.power(error, 2).mean()),
+                         coverage])
+        index = pd.Index(number_of_neighbors, name='neighbors')
+        return pd.DataFrame(rows, index=index, columns=['count', 'mean_error', 'mae', 'rmse', 'ci_coverage'])
+
+    def _neighbor_counts(self, number_of_neighbors):
+        if not number_of_neighbors:
+            number_of_neighbors = [self.max_neighbors]
+        if not hasattr(number_of_neighbors, "__iter__"):
+            number_of_neighbors = [number_of_neighbors]
+        return list(number_of_neighbors)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+build.py
+
+A build pipeline that ingests the ie_data file, derives the analysis frames, and exports the UI data.
+
+Each stage's output is cached together with a fingerprint of its inputs and parameters. A stage is
+skipped when its fingerprint is unchanged, and derivations that need rebuilding run concurrently.
+
+Created by Chandrasekhar Ramakrishnan on 2017-11-27.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# The analysis modules are imported where they are used, so that checking whether
+# stages are up to date does not require importing pandas.
+
+# Bump to invalidate all cached stages when the format of the cache changes. Changes to the
+# computations are picked up from the sources of CODE_MODULES.
+BUILD_VERSION = 2
+
+# The modules whose code determines the stage outputs
+CODE_MODULES = ['reader', 'data_series', 'kernels', '_numba_kernels', 'analysis', 'returns', 'ui', 'snapshot',
+                'build']
+
+# Matches ui.UI_HORIZONS
+HORIZONS = list(range(10, 21))
+
+# Matches returns.BOND_MODELS
+BOND_MODELS = ['hold_to_maturity', 'total']
+
+# Matches snapshot.CAPE_VARIANTS
+CAPE_VARIANTS = [[years, summary] for years in (5, 10, 15, 20) for summary in ('mean', 'median')]
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of the contents of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_digest(modules=CODE_MODULES):
+    """Return the sha256 hex digest of the sources of the stockscape modules, read without importing them."""
+    digest = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        digest.update(module.encode('utf-8'))
+        digest.update(file_digest(os.path.join(folder, "{}.py".format(module))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint(*parts):
+    """Return a sha256 hex digest of parts, which must be JSON-serializable."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def atomic_write(path, data, mode='wb'):
+    """Write data to a temporary file next to path and move it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def derive_cape(data, years=10, summary='mean'):
+    from .analysis import Cape
+    return Cape(data, years, summary).df
+
+
+def derive_stock_returns(data, horizons=HORIZONS):
+    from .returns import StockReturns
+    return {h: StockReturns(data, h).df for h in horizons}
+
+
+def derive_inflation(data, horizons=HORIZONS):
+    from .returns import Inflation
+    return {h: Inflation(data, h).df for h in horizons}
+
+
+def derive_bonds(data, horizons=HORIZONS, model='hold_to_maturity'):
+    from .returns import bond_returns_dfs
+    return bond_returns_dfs(data, horizons, model)
+
+
+def derive_cape_variants(data, variants=CAPE_VARIANTS):
+    from .analysis import Cape
+    return {(years, summary): Cape(data, years, summary).df for years, summary in variants}
+
+
+def derive_waiting_returns(data, horizons=(10, 15, 20), waits=(1, 2, 3)):
+    from .returns import WaitingReturns
+    return WaitingReturns(data, list(horizons), list(waits))
+
+
+def derive_ui_data(cape, stock_returns, bonds, inflation):
+    from .ui import UiData
+    return UiData.from_frames(cape, stock_returns, bonds, inflation)
+
+
+DERIVATIONS = {
+    'cape': (derive_cape, {'years': 10, 'summary': 'mean'}),
+    'cape_variants': (derive_cape_variants, {'variants': CAPE_VARIANTS}),
+    'stock_returns': (derive_stock_returns, {'horizons': HORIZONS}),
+    'inflation': (derive_inflation, {'horizons': HORIZONS}),
+    'bonds': (derive_bonds, {'horizons': HORIZONS, 'model': 'hold_to_maturity'}),
+    'waiting_returns': (derive_waiting_returns, {'horizons': [10, 15, 20], 'waits': [1, 2, 3]}),
+    'ui_data': (derive_ui_data, {}),
+}
+
+# The derivations computed from the outputs of other derivations, instead of from the ingested data.
+# Their inputs are passed to them as keyword arguments named after the stages.
+DERIVATION_INPUTS = {
+    'ui_data': ['cape', 'stock_returns', 'bonds', 'inflation'],
+}
+
+# The derivations the snapshot is assembled from
+SNAPSHOT_INPUTS = ['cape', 'stock_returns', 'bonds', 'inflation', 'cape_variants']
+
+
+def _run_derivation(name, params, input_paths, output_path):
+    """Compute a derivation from cached stage outputs and cache the result. Runs in a worker process.
+    :param input_paths: A dict of argument name to the path of the cached output passed as that argument
+    """
+    inputs = {}
+    for arg, path in input_paths.items():
+        with open(path, 'rb') as f:
+            inputs[arg] = pickle.load(f)
+    func, _ = DERIVATIONS[name]
+    atomic_write(output_path, pickle.dumps(func(**dict(inputs, **params)), pickle.HIGHEST_PROTOCOL))
+    return name
+
+
+class Pipeline(object):
+    """Run the ingest, derive, and export stages, skipping those whose fingerprint is unchanged."""
+
+    def __init__(self, ie_data_path, cache_dir='.stockscape-cache', jobs=None, force=False, log=None,
+                 bond_model='hold_to_maturity'):
+        """
+        :param ie_data_path: Path to an ie_data file
+        :param cache_dir: The folder to keep stage outputs and fingerprints in
+        :param jobs: The maximum number of derivations to run concurrently. Defaults to the number of CPUs.
+        :param force: If True, rebuild every stage
+        :param log: A function called with a status line for each stage. Defaults to doing nothing.
+        :param bond_model: How the bonds stage computes returns, one of BOND_MODELS. 'total' computes all
+        horizons in one pass (see returns.bond_returns_dfs).
+        """
+        if bond_model not in BOND_MODELS:
+            raise ValueError("Unknown bond model {}. Expected one of {}".format(bond_model, BOND_MODELS))
+        self.ie_data_path = ie_data_path
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.force = force
+        self.log = log if log else (lambda line: None)
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = self._read_manifest()
+        self.fingerprints = {}
+        # The parameters of each derivation; changing them changes the fingerprints of the stage and its dependents
+        self.params = {name: dict(params) for name, (_, params) in DERIVATIONS.items()}
+        self.params['bonds']['model'] = bond_model
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _record(self, name):
+        self.manifest[name] = self.fingerprints[name]
+        atomic_write(self.manifest_path, json.dumps(self.manifest, indent=2, sort_keys=True), 'w')
+
+    def output_path(self, name):
+        """Return the path of the cached output of the stage name."""
+        return os.path.join(self.cache_dir, "{}.pkl".format(name))
+
+    def load(self, name):
+        """Return the cached output of the stage name."""
+        with open(self.output_path(name), 'rb') as f:
+            return pickle.load(f)
+
+    def is_current(self, name, *paths):
+        """Return True if the stage name can be skipped: its fingerprint is unchanged and its outputs exist."""
+        if self.force or self.manifest.get(name) != self.fingerprints[name]:
+            return False
+        return all(os.path.exists(p) for p in paths)
+
+    def ingest(self):
+        """Read the ie_data file into the cache, unless its contents are unchanged."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.fingerprints['ingest'] = fingerprint(BUILD_VERSION, code_digest(), file_digest(self.ie_data_path))
+        if self.is_current('ingest', self.output_path('ingest')):
+            self.log("ingest: unchanged")
+            return
+        from .reader import read_ie_data
+        start = time.time()
+        data = read_ie_data(self.ie_data_path)
+        atomic_write(self.output_path('ingest'), pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        self._record('ingest')
+        self.log("ingest: built in {:.2f}s".format(time.time() - start))
+
+    def derive(self, names=None):
+        """Compute the derivations in names (defaults to all), and those they depend on, that are out of date.
+
+        Derivations of the ingested data run concurrently, followed by those that depend on them.
+        """
+        if 'ingest' not in self.fingerprints:
+            self.ingest()
+        names = sorted(DERIVATIONS.keys()) if names is None else names
+        needed = set(names).union(*[DERIVATION_INPUTS.get(name, []) for name in names])
+        self._derive_stale(sorted(n for n in needed if n not in DERIVATION_INPUTS))
+        self._derive_stale(sorted(n for n in needed if n in DERIVATION_INPUTS))
+
+    def _derive_stale(self, names):
+        stale = []
+        # Stages already checked by this pipeline are up to date
+        for name in [n for n in names if n not in self.fingerprints]:
+            inputs = DERIVATION_INPUTS.get(name, ['ingest'])
+            self.fingerprints[name] = fingerprint(name, self.params[name],
+                                                  *[self.fingerprints[i] for i in inputs])
+            if self.is_current(name, self.output_path(name)):
+                self.log("{}: unchanged".format(name))
+            else:
+                stale.append(name)
+        if not stale:
+            return
+
+        start = time.time()
+        args = [(name, self.params[name], self._input_paths(name), self.output_path(name)) for name in stale]
+        if self.jobs == 1 or len(stale) == 1:
+            done = [_run_derivation(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                done = list(executor.map(_run_derivation, *zip(*args)))
+        for name in done:
+            self._record(name)
+            self.log("{}: built".format(name))
+        self.log("derive: {} stage(s) built in {:.2f}s".format(len(done), time.time() - start))
+
+    def _input_paths(self, name):
+        if name not in DERIVATION_INPUTS:
+            return {'data': self.output_path('ingest')}
+        return {i: self.output_path(i) for i in DERIVATION_INPUTS[name]}
+
+    def export(self, path, snapshot_path=None):
+        """Write the UI data to path and, optionally, a snapshot to snapshot_path, if they are out of date.
+
+        Both are assembled from the cached derivations.
+        """
+        self.derive(['ui_data'] + (SNAPSHOT_INPUTS if snapshot_path is not None else []))
+        name = 'export'
+        self.fingerprints[name] = fingerprint(name, os.path.abspath(path), self.fingerprints['ui_data'])
+        if self.is_current(name, path):
+            self.log("export: unchanged")
+        else:
+            self.load('ui_data').write(path)
+            self._record(name)
+            self.log("export: wrote {}".format(path))
+
+        if snapshot_path is None:
+            return
+        name = 'snapshot'
+        self.fingerprints[name] = fingerprint(name, os.path.abspath(snapshot_path),
+                                              *[self.fingerprints[i] for i in SNAPSHOT_INPUTS])
+        if self.is_current(name, snapshot_path):
+            self.log("snapshot: unchanged")
+        else:
+            from .snapshot import snapshot_df_from_frames, write_snapshot_df
+            from .ui import UiData
+            columns = UiData.columns_from_frames(*[self.load(i) for i in ['cape', 'stock_returns', 'bonds',
+                                                                          'inflation']])
+            write_snapshot_df(snapshot_df_from_frames(columns, self.load('cape_variants')), snapshot_path)
+            self._record(name)
+            self.log("snapshot: wrote {}".format(snapshot_path))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+chunked.py
+
+Evaluate the windowed computations of the pipeline (real prices, rolling CAPE, forward returns, forward
+inflation) on series that do not fit in memory.
+
+Series are stored as a folder of .npy files, one per column, and read through memory maps. Each
+computation processes the series in blocks, extended by a halo on either side that is large enough for
+its window, and writes the block's results to an .npy file on disk. Peak memory depends on the block
+size and the window, not on the length of the series.
+
+The numpy kernel backend materializes each window of a block for the rolling median, so its memory
+grows with chunk_size * window; prefer the numba backend, or smaller chunks, for a median CAPE over
+long windows (e.g., daily data).
+
+Created by Chandrasekhar Ramakrishnan on 2017-12-18.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import kernels
+
+DEFAULT_CHUNK_SIZE = 8192
+INDEX_COLUMN = '_index'
+
+
+def write_columns(df, folder):
+    """Write each column of df, and its (datetime) index, to folder as .npy files."""
+    os.makedirs(folder, exist_ok=True)
+    np.save(os.path.join(folder, INDEX_COLUMN + '.npy'), pd.DatetimeIndex(df.index).values.astype(np.int64))
+    for column in df.columns:
+        np.save(os.path.join(folder, "{}.npy".format(column)), pd.to_numeric(df[column]).values.astype(np.float64))
+
+
+def write_ie_data_columns(stockscape_data, folder):
+    """Write the nominal price (P), dividend (D), earnings (E), and CPI columns of the data to folder."""
+    df = stockscape_data.nominal_data.stocks_df[['P', 'D', 'E']]
+    write_columns(df.assign(CPI=stockscape_data.real_stock_data.cpi_s), folder)
+
+
+def open_columns(folder):
+    """Return a dict of column name to read-only memory-mapped array for the columns in folder."""
+    columns = {}
+    for file_name in sorted(os.listdir(folder)):
+        name, ext = os.path.splitext(file_name)
+        if ext == '.npy' and name != INDEX_COLUMN:
+            columns[name] = np.load(os.path.join(folder, file_name), mmap_mode='r')
+    return columns
+
+
+def read_columns(folder):
+    """Read the columns in folder into a frame indexed by date. Only use this for data that fits in memory."""
+    index = pd.DatetimeIndex(np.load(os.path.join(folder, INDEX_COLUMN + '.npy')).astype('datetime64[ns]'))
+    return pd.DataFrame({name: np.asarray(values) for name, values in open_columns(folder).items()}, index=index)
+
+
+def map_blocks(func, inputs, output_path, chunk_size=DEFAULT_CHUNK_SIZE, before=0, after=0):
+    """Apply func block by block to inputs, writing the results to output_path as .npy.
+
+    :param func: A function (blocks, offset) -> array. blocks is a dict of name to float64 array, covering the
+                 same positions for all inputs, and offset is the position of the first element in the series.
+                 It must return an array of the same length as the blocks.
+    :param inputs: A dict of name to array-like (typically memory-mapped) of equal length
+    :param output_path: The .npy file to write
+    :param chunk_size: The number of results computed per block
+    :param before: The number of positions before a result it depends on
+    :param after: The number of positions after a result it depends on
+    :return: The results, memory-mapped read-only
+    """
+    n = len(next(iter(inputs.values())))
+    out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64, shape=(n,))
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        lo = max(0, start - before)
+        hi = min(n, end + after)
+        blocks = {name: np.asarray(values[lo:hi], dtype=np.float64) for name, values in inputs.items()}
+        out[start:end] = func(blocks, lo)[start - lo:end - lo]
+    out.flush()
+    del out
+    return np.load(output_path, mmap_mode='r')
+
+
+class ChunkedPipeline(object):
+    """Compute real prices, CAPE, forward stock returns, and forward inflation in bounded memory.
+
+    The results match Cape, StockReturns, and Inflation, and the horizon columns are named like UiData's.
+    """
+
+    def __init__(self, source_folder, output_folder, periods_per_year=12, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param source_folder: A folder with P, D, E, and CPI columns (see write_ie_data_columns)
+        :param output_folder: The folder to write the results to
+        :param periods_per_year: The number of rows per year, e.g., 12 for monthly data
+        :param chunk_size: The number of rows computed per block
+        """
+        self.source_folder = source_folder
+        self.output_folder = output_folder
+        self.periods_per_year = periods_per_year
+        self.chunk_size = chunk_size
+        os.makedirs(output_folder, exist_ok=True)
+        self.source = open_columns(source_folder)
+        self.columns = {}
+
+    def _map(self, name, func, inputs, before=0, after=0):
+        path = os.path.join(self.output_folder, "{}.npy".format(name))
+        self.columns[name] = map_blocks(func, inputs, path, self.chunk_size, before, after)
+        return self.columns[name]
+
+    def run(self, cape_years=10, summary='mean', horizons=(10,)):
+        """Compute all results and write them to the output folder.
+        :param cape_years: The period to look at when computing CAPE, specified in years
+        :param summary: The summary statistic to use for CAPE: 'mean' or 'median'
+        :param horizons: The periods, in years, over which forward returns and inflation are computed
+        :return: A dict of column name to memory-mapped results
+        """
+        index_path = os.path.join(self.source_folder, INDEX_COLUMN + '.npy')
+        if os.path.exists(index_path):
+            np.save(os.path.join(self.output_folder, INDEX_COLUMN + '.npy'), np.load(index_path, mmap_mode='r'))
+        self.real_stock_data()
+        self.cape(cape_years, summary)
+        for horizon in horizons:
+            self.stock_returns(horizon)
+            self.inflation(horizon)
+        return self.columns
+
+    def real_stock_data(self):
+        """Compute the real price, dividend, earnings, and monthly return (see data_series.RealStockData)."""
+        cpi = self.source['CPI']
+        base_price_level = float(cpi[-1])
+        periods_per_year = self.periods_per_year
+
+        for name, nominal in [('price', 'P'), ('dividend', 'D'), ('earnings', 'E')]:
+            self._map(name, lambda b, offset: b['value'] * base_price_level / b['CPI'],
+                      {'value': self.source[nominal], 'CPI': cpi})
+
+        def m_return(b, offset):
+            price = b['price']
+            previous = np.concatenate([[np.nan], price[:-1]])
+            return (price - previous + b['dividend'] / periods_per_year) / previous
+
+        self._map('m_return', m_return, {'price': self.columns['price'], 'dividend': self.columns['dividend']},
+                  before=1)
+
+    def cape(self, years=10, summary='mean'):
+        """Compute CAPE from the summary of the earnings in the years before each row (see analysis.Cape)."""
+        window = years * self.periods_per_year
+        summary = 'mean' if summary == 'mean' else 'median'
+
+        def cape(b, offset):
+            earnings = kernels.rolling_summary(b['earnings'], window, summary)
+            # Do not include the current row, and require a full history
+            earnings = np.concatenate([[np.nan], earnings[:-1]])
+            earnings[0:max(0, window - offset)] = np.nan
+            return b['price'] / earnings
+
+        return self._map('cape', cape, {'price': self.columns['price'], 'earnings': self.columns['earnings']},
+                         before=window)
+
+    def stock_returns(self, years=10):
+        """Compute forward gross and annualized real stock returns (see returns.StockReturns)."""
+        periods = years * self.periods_per_year
+        self._map('stockgross_{}y'.format(years),
+                  lambda b, offset: kernels.forward_product(1 + b['m_return'], periods) - 1,
+                  {'m_return': self.columns['m_return']}, after=periods)
+        self._map('stock_{}y'.format(years), lambda b, offset: np.power(1 + b['gross'], 1 / years) - 1,
+                  {'gross': self.columns['stockgross_{}y'.format(years)]})
+
+    def inflation(self, years=10):
+        """Compute annualized forward inflation (see returns.Inflation)."""
+        periods = years * self.periods_per_year
+
+        def forward_inflation(b, offset):
+            cpi = b['CPI']
+            future = np.full(len(cpi), np.nan)
+            future[0:max(0, len(cpi) - periods)] = cpi[periods:]
+            return np.power(future / cpi, 1 / years) - 1
+
+        self._map('inflation_{}y'.format(years), forward_inflation, {'CPI': self.source['CPI']}, after=periods)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cli.py
+
+The stockscape command-line tool.
+
+  stockscape ingest ie_data.xls
+  stockscape derive ie_data.xls
+  stockscape export ie_data.xls ui_data.json [--snapshot derived.snap]
+  stockscape build ie_data.xls ui_data.json [--snapshot derived.snap]
+  stockscape figures ie_data.xls figures/ [--format png svg] [figure ...]
+  stockscape serve ie_data.xls [--host 127.0.0.1] [--port 8080]
+
+Created by Chandrasekhar Ramakrishnan on 2017-11-27.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import argparse
+import sys
+
+from .build import BOND_MODELS, DERIVATIONS, Pipeline
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='stockscape', description="Build the stockscape data products.")
+    parser.add_argument('--cache-dir', default='.stockscape-cache', help="Folder for cached stage outputs")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of derivations to run concurrently")
+    parser.add_argument('--force', action='store_true', help="Rebuild all stages, even if unchanged")
+    parser.add_argument('--quiet', '-q', action='store_true', help="Do not report on each stage")
+    parser.add_argument('--bond-model', choices=BOND_MODELS, default='hold_to_maturity',
+                        help="How bond returns are computed: held to maturity, or the total returns of a rolling "
+                             "bond portfolio, computed for all horizons in one pass")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser('ingest', help="Read the ie_data file")
+    ingest.add_argument('ie_data', help="Path to an ie_data file")
+
+    derive = subparsers.add_parser('derive', help="Compute CAPE, returns, inflation, bonds, and waiting returns")
+    derive.add_argument('ie_data', help="Path to an ie_data file")
+    derive.add_argument('stages', nargs='*', metavar='stage',
+                        help="The derivations to compute (default: all): {}".format(", ".join(sorted(DERIVATIONS))))
+
+    for name, help_text in [('export', "Write the UI data"), ('build', "Run all stages and write the UI data")]:
+        export = subparsers.add_parser(name, help=help_text)
+        export.add_argument('ie_data', help="Path to an ie_data file")
+        export.add_argument('output', help="Path to write the UI data (json) to")
+        export.add_argument('--snapshot', help="Also write a memory-mappable snapshot to this path")
+
+    figures = subparsers.add_parser('figures', help="Render the DeLong-Shiller Redux figures")
+    figures.add_argument('ie_data', help="Path to an ie_data file")
+    figures.add_argument('out_dir', help="Folder to write the figures to")
+    figures.add_argument('names', nargs='*', metavar='figure', help="The figures to render (default: all)")
+    figures.add_argument('--format', nargs='+', default=['png'], dest='formats', help="The file formats to write")
+
+    serve = subparsers.add_parser('serve', help="Serve the UI data over HTTP")
+    serve.add_argument('ie_data', help="Path to an ie_data file")
+    serve.add_argument('--host', default='127.0.0.1', help="The interface to listen on")
+    serve.add_argument('--port', type=int, default=8080, help="The port to listen on")
+    serve.add_argument('--poll-interval', type=float, default=5.0,
+                       help="Seconds between checks for changes to the ie_data file")
+    return parser
+
+
+def render_figures(args, log):
+    # The figure module needs seaborn and statsmodels, so only import it when asked to.
+    from . import dsr_figures
+    unknown = [n for n in args.names if n not in dsr_figures.FIGURES]
+    if unknown:
+        raise SystemExit("unknown figure(s): {}".format(", ".join(unknown)))
+    pipeline = Pipeline(args.ie_data, args.cache_dir, args.jobs, args.force, log, args.bond_model)
+    pipeline.ingest()
+    dsr_figures.build_figures(pipeline.load('ingest'), args.out_dir, args.names if args.names else None,
+                              args.formats, jobs=args.jobs, log=log)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    unknown = [s for s in getattr(args, 'stages', []) if s not in DERIVATIONS]
+    if unknown:
+        parser.error("unknown stage(s): {}".format(", ".join(unknown)))
+    log = None if args.quiet else (lambda line: print(line, file=sys.stderr))
+    if args.command == 'figures':
+        render_figures(args, log)
+        return 0
+    if args.command == 'serve':
+        from .server import serve
+        if log:
+            log("serving {} on http://{}:{}/".format(args.ie_data, args.host, args.port))
+        serve(args.ie_data, args.host, args.port, args.poll_interval, log)
+        return 0
+    pipeline = Pipeline(args.ie_data, args.cache_dir, args.jobs, args.force, log, args.bond_model)
+    if args.command == 'ingest':
+        pipeline.ingest()
+    elif args.command == 'derive':
+        pipeline.derive(args.stages if args.stages else None)
+    elif args.command == 'export':
+        pipeline.export(args.output, args.snapshot)
+    else:
+        pipeline.derive()
+        pipeline.export(args.output, args.snapshot)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,6 +18,8 @@ import pandas as pd
 
 import statsmodels.formula.api as smf
 
+from . import kernels
+
 
 def time_ticks(hop=10, start=1880, end=2020):
     """Standard tick points for DSR visualizations"""
@@ -26,16 +28,9 @@ def time_ticks(hop=10, start=1880, end=2020):
 
 def periods_from_df(time_df):
     """Take a frame and return a breakdown of the consecutive periods represented in the frame."""
-    period = [time_df.index[0]]
-    periods = [period]
-    all_period_years = [time_df.index[0]]
-    for i in range(1, len(time_df.index)):
-        all_period_years.append(time_df.index[i])
-        if time_df.index[i - 1] + 1 == time_df.index[i]:
-            period.append(time_df.index[i])
-        else:
-            period = [time_df.index[i]]
-            periods.append(period)
+    all_period_years = list(time_df.index)
+    starts = list(kernels.run_starts(time_df.index.values)) + [len(all_period_years)]
+    periods = [all_period_years[start:end] for start, end in zip(starts[:-1], starts[1:])]
     period_labels = ["{}-{}".format(p[0], p[-1]) for p in periods]
     return all_period_years, [(p, pl) for p, pl in zip(periods, period_labels)]
 
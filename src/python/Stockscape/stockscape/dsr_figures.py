@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+dsr_figures.py
+
+Build the figures for the DeLong-Shiller Redux (dsr) without a notebook.
+
+Each figure is a function of named data inputs and the style preferences. Figures are rendered
+in a process pool whose workers use the Agg backend, and the outputs are cached by a hash of the input
+data, the style preferences, and the code of this module and dsr, so only figures whose inputs changed
+are redrawn.
+
+FIGURES holds every figure of the notebook (analysis/jupyter/DeLong-Shiller-Redux.ipynb) except the
+palette swatches, which only illustrate the style.
+
+Created by Chandrasekhar Ramakrishnan on 2017-12-04.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from . import dsr
+from .analysis import Cape, CapeNeighborsEstimator, WarrantedReturns
+from .build import atomic_write
+from .returns import BondHoldToMaturityReturns, Inflation, StockReturns, WaitingReturns
+
+FIGURES = OrderedDict()
+
+
+def figure(name, inputs):
+    """Decorator that registers a figure function.
+
+    The function is called with the style preferences and the named inputs as keyword arguments
+    and returns a matplotlib figure.
+    :param name: The name of the figure, used for the output file name
+    :param inputs: The names of the data inputs (see INPUTS) the figure is drawn from
+    """
+
+    def register(func):
+        FIGURES[name] = (func, list(inputs))
+        return func
+
+    return register
+
+
+# Inputs
+
+def _df_10y(data):
+    cape = Cape(data, 10)
+    stocks = StockReturns(data, 10)
+    wr = WarrantedReturns(cape, stocks)
+    return cape.df.join(stocks.df).join(wr.df).join(BondHoldToMaturityReturns(data).df).join(Inflation(data, 10).df)
+
+
+def _wr_curves(data):
+    cape = Cape(data, 10)
+    curves = {}
+    for horizon in [10, 15, 20]:
+        wr = WarrantedReturns(cape, StockReturns(data, horizon))
+        cape_range, curve = wr.warranted_returns_curve()
+        _, gross_curve = wr.gross_warranted_returns_curve()
+        curves['cape'] = cape_range
+        curves['wr_{}y'.format(horizon)] = curve
+        curves['gross_wr_{}y'.format(horizon)] = gross_curve
+    return pd.DataFrame(curves)
+
+
+def _horizon_returns(data):
+    cape = Cape(data, 10)
+    columns = {'cape': cape.df['cape']}
+    for horizon in [10, 15, 20]:
+        stocks = StockReturns(data, horizon)
+        columns['returns_{}y'.format(horizon)] = stocks.df['returns']
+        columns['gross_returns_{}y'.format(horizon)] = stocks.df['gross_returns']
+        columns['wr_error_{}y'.format(horizon)] = WarrantedReturns(cape, stocks).df['wr_error']
+    return pd.DataFrame(columns)
+
+
+def _wait_returns(data):
+    wait_returns = WaitingReturns(data, [10, 15, 20], range(1, 4))
+    df = pd.concat(wait_returns.wait_dfs, axis=1, keys=wait_returns.horizons, names=['horizon', 'wait'])
+    df[('cape', 0)] = Cape(data, 10).df['cape']
+    return df
+
+
+def _predictions_10y(data):
+    cape = Cape(data, 10)
+    stocks = StockReturns(data, 10)
+    predictor = CapeNeighborsEstimator(cape).fit(stocks.df, 'gross_returns')
+    return predictor.predict(19, stocks.period_utils.annualized_returns, 'returns').join(cape.df['cape'])
+
+
+def _horizon_predictions(data):
+    cape = Cape(data, 10)
+    estimator = CapeNeighborsEstimator(cape)
+    columns = {'cape': cape.df['cape']}
+    for horizon in [10, 15, 20]:
+        stocks = StockReturns(data, horizon)
+        predictor = estimator.fit(stocks.df, 'gross_returns')
+        columns['returns_{}y'.format(horizon)] = \
+            predictor.predict(19, stocks.period_utils.annualized_returns, 'returns')['returns']
+    df = pd.DataFrame(columns).dropna(how='all', subset=['returns_10y', 'returns_15y', 'returns_20y'])
+    # Remove 20y estimates for cape > 32 -- we don't have good data to make predictions
+    df.loc[df['cape'] > 32, 'returns_20y'] = np.nan
+    return df
+
+
+def _stock_bond_diff(data):
+    df_10y = _df_10y(data)
+    df = pd.DataFrame({'stocks_bonds_diff': df_10y['returns'] - df_10y['gs10_returns']})
+    predictor = CapeNeighborsEstimator(Cape(data, 10)).fit(df, 'stocks_bonds_diff')
+    predictions = predictor.predict(19)['stocks_bonds_diff']
+    return df.assign(cape=df_10y['cape'], prediction=predictions)
+
+
+INPUTS = {
+    'df_10y': _df_10y,
+    'gs10': lambda data: data.nominal_data.gs10_s,
+    'wr_curves': _wr_curves,
+    'horizon_returns': _horizon_returns,
+    'wait_returns': _wait_returns,
+    'predictions_10y': _predictions_10y,
+    'horizon_predictions': _horizon_predictions,
+    'stock_bond_diff': _stock_bond_diff,
+}
+
+
+def _stocks_df(horizon_returns, horizon):
+    """Return the returns and gross_returns for horizon, named like StockReturns.df."""
+    return pd.DataFrame({col: horizon_returns['{}_{}y'.format(col, horizon)] for col in ['returns', 'gross_returns']})
+
+
+def _gross_limits(horizon_returns):
+    gross = horizon_returns[['gross_returns_{}y'.format(h) for h in [10, 15, 20]]]
+    return [gross.min().min(), gross.max().max()]
+
+
+def _plot_predictions(ax, prefs, cape, actual, predictions, arrow_start=-18, num_labels=3):
+    """Scatter the actual values and the predictions against CAPE, with arrows between the latest predictions.
+    :param cape: The CAPE series, indexed like actual
+    :param actual: The realized values
+    :param predictions: A frame with cape and prediction columns, holding only the predicted rows
+    """
+    ax.scatter(cape, actual, alpha=0.7, color=prefs.s_palette[3],
+               label="up to {}".format(dsr.latest_index_label(actual.dropna())))
+    ax.scatter(predictions['cape'], predictions['prediction'], alpha=0.7, color=prefs.l_palette[2],
+               label="predictions")
+    x = predictions['cape'].values
+    y = predictions['prediction'].values
+    ax.quiver(x[arrow_start:-1], y[arrow_start:-1], x[arrow_start + 1:] - x[arrow_start:-1],
+              y[arrow_start + 1:] - y[arrow_start:-1], scale_units='xy', angles='xy', scale=1, headwidth=2,
+              headlength=4.5, color=prefs.l_palette[2], alpha=0.6)
+    for i in range(num_labels):
+        pos = int(-1 + (i * (arrow_start / num_labels)))
+        ax.text(x[pos], y[pos] + 0.005, "{}".format(predictions.index[pos].strftime("%Y-%m")))
+
+
+# Figures
+
+@figure('returns_10y_by_cape', ['df_10y', 'wr_curves'])
+def returns_10y_by_cape(prefs, df_10y, wr_curves):
+    fig, ax = plt.subplots()
+    to_delong, since_delong = dsr.split_to_and_since_delong(df_10y)
+    ax.scatter(to_delong['cape'], to_delong['returns'], alpha=0.7, color=prefs.s_palette[3],
+               label="up to {}".format(dsr.latest_index_label(to_delong)))
+    ax.scatter(since_delong['cape'], since_delong['returns'], alpha=0.7, color=prefs.s_palette[0],
+               label="{} - {}".format(dsr.latest_index_label(to_delong), dsr.latest_index_label(since_delong)))
+    ss_res = np.sum(np.power(df_10y['wr_error'], 2))
+    ss_tot = np.sum(np.power(df_10y['returns'] - df_10y['returns'].mean(), 2))
+    rsquared = 1 - (ss_res / ss_tot)
+    cape_range, wr = wr_curves['cape'].values, wr_curves['wr_10y'].values
+    ax.text(cape_range[-5], wr[-5] + 0.005, "$r^2={:.3f}$".format(rsquared))
+    ax.plot(cape_range, wr, color=prefs.l_palette[0], alpha=0.9)
+    ax.set_ylabel("Annual Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10-Year Stock Returns")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('wr_error_10y', ['df_10y'])
+def wr_error_10y(prefs, df_10y):
+    fig, ax = plt.subplots()
+    ax.scatter(df_10y['cape'], df_10y['wr_error'], alpha=0.7, color=prefs.s_palette[1])
+    median = df_10y['wr_error'].median()
+    ax.axhline(median, alpha=0.9, color=prefs.l_palette[0], label='error median')
+    ax.text(40, median, "{:.3f}".format(median))
+    ax.set_ylabel("Acutal Returns - Warranted Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10Y Stock Returns Predicted by CAPE-Warranted Returns")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('high_cape_periods', ['df_10y'])
+def high_cape_periods(prefs, df_10y):
+    fig, ax = plt.subplots()
+    high_cape, under_25 = dsr.split_cape_threshold_years(df_10y, 25)
+    ax.scatter(under_25.index, under_25['cape'], alpha=0.3, color=prefs.s_palette[1], label="cape under 25")
+    for (name, group_df), color in zip(high_cape.groupby('period'), prefs.l_palette[2:]):
+        ax.scatter(group_df.index, group_df['cape'], alpha=0.3, color=color, label=name)
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('gs10_returns', ['df_10y', 'gs10'])
+def gs10_returns(prefs, df_10y, gs10):
+    fig, ax = plt.subplots(figsize=prefs.figure_small_size)
+    ax.plot(gs10.index, gs10, color=prefs.b_palette[3], alpha=0.7, label='nominal yield')
+    ax.plot(df_10y.index, df_10y['forward_inflation'], color=prefs.l_palette[2], alpha=0.5, label='forward inflation')
+    ax.plot(df_10y.index, df_10y['gs10_returns'], color=prefs.b_palette[0], label='real returns')
+    ax.set_ylabel("Annual Rate")
+    ax.set_title("GS10 Return")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('stock_bond_returns_10y', ['df_10y'])
+def stock_bond_returns_10y(prefs, df_10y):
+    fig, ax = plt.subplots(figsize=prefs.figure_small_size)
+    ax.plot(df_10y.index, df_10y['returns'], alpha=0.9, color=prefs.s_palette[0], label="stock returns")
+    ax.plot(df_10y.index, df_10y['gs10_returns'], alpha=0.9, color=prefs.b_palette[0], label="bond returns")
+    ax.set_ylabel("Annual Returns")
+    ax.set_title("10Y Stock and Bond Returns")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('stock_bond_returns_by_cape', ['df_10y', 'wr_curves'])
+def stock_bond_returns_by_cape(prefs, df_10y, wr_curves):
+    fig, ax = plt.subplots()
+    cape_range, wr = wr_curves['cape'].values, wr_curves['wr_10y'].values
+    ax.scatter(df_10y['cape'], df_10y['gs10_returns'], edgecolor='none', alpha=0.5, color=prefs.b_palette[1],
+               label='bond returns')
+    lm = dsr.LinearModel('cape', 'gs10_returns', df_10y, [cape_range[0], cape_range[-1]]).fit_and_predict()
+    ax.plot(lm.pred_range, lm.predictions, color=prefs.b_palette[0], lw=3, label='bond returns regression')
+    ax.axhline(df_10y['gs10_returns'].mean(), alpha=0.7, color=prefs.b_palette[1], lw=3)
+    ax.text(45, df_10y['gs10_returns'].mean() + 0.005, "mean bond returns")
+    ax.axhline(df_10y['gs10_returns'].median(), alpha=0.7, color=prefs.b_palette[1], lw=3)
+    ax.text(45, df_10y['gs10_returns'].median() - 0.01, "median bond returns")
+    ax.scatter(df_10y['cape'], df_10y['returns'], edgecolor='none', alpha=0.5, color=prefs.s_palette[1],
+               label='stock returns')
+    ax.plot(cape_range, wr, color=prefs.s_palette[0], alpha=1.0, lw=3, label='warranted stock returns')
+    ax.set_ylabel("Annual Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10Y Stock and Bond Returns by CAPE")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('returns_cape_over_25', ['df_10y'])
+def returns_cape_over_25(prefs, df_10y):
+    tdf = df_10y[df_10y['cape'] >= 25]
+    fig, ax = plt.subplots(figsize=prefs.figure_medium_size)
+    ax.scatter(tdf['cape'], tdf['gs10_returns'], edgecolor='none', alpha=0.7, color=prefs.b_palette[0],
+               label='bond returns')
+    ax.axhline(tdf['gs10_returns'].median(), alpha=0.7, color=prefs.b_palette[0], label='median bond returns')
+    ax.scatter(tdf['cape'], tdf['returns'], edgecolor='none', color=prefs.s_palette[0], alpha=0.7,
+               label='stock returns')
+    ax.axhline(tdf['returns'].median(), alpha=0.7, color=prefs.s_palette[0], label='median stock returns')
+    ax.set_ylabel("Annual Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10Y Returns for CAPE >= 25")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('stock_bond_diff_by_cape', ['df_10y', 'wr_curves'])
+def stock_bond_diff_by_cape(prefs, df_10y, wr_curves):
+    cape_range = wr_curves['cape'].values
+    df = df_10y.assign(s_b_diff=df_10y['returns'] - df_10y['gs10_returns'])
+    high_cape, under_25 = dsr.split_cape_threshold_years(df, 25)
+    under_25 = df.loc[under_25.index]
+    lm_alldata = dsr.LinearModel('cape', 's_b_diff', df, [cape_range[0], cape_range[-1]]).fit_and_predict()
+    lm_lt25 = dsr.LinearModel('cape', 's_b_diff', under_25, [cape_range[0], cape_range[-1]]).fit_and_predict()
+
+    fig, ax = plt.subplots()
+    ax.scatter(under_25['cape'], under_25['s_b_diff'], alpha=0.5, color=prefs.s_palette[1], label='cape under 25')
+    for (name, group_df), color in zip(list(high_cape.groupby('period'))[0:2], prefs.l_palette[2:]):
+        ax.scatter(df.loc[group_df.index, 'cape'], df.loc[group_df.index, 's_b_diff'], alpha=0.5, color=color,
+                   label=name)
+    ax.set_ylabel("Stock - Bond Returns")
+    ax.set_xlabel("CAPE")
+    ax.plot(lm_alldata.pred_range, lm_alldata.predictions, color=prefs.l_palette[0], alpha=0.9, lw=3.0,
+            label="regression all data")
+    ax.text(40, -0.047, "$r^2={:.2f}$".format(lm_alldata.rsquared))
+    ax.annotate("{:.2f}".format(lm_alldata.x_intercept), xy=(lm_alldata.x_intercept, 0), xytext=(30, 0.05),
+                arrowprops=dict(facecolor='black', arrowstyle="-|>"))
+    ax.plot(lm_lt25.pred_range, lm_lt25.predictions, color=prefs.l_palette[1], alpha=0.9, lw=3.0,
+            label='regression cape < 25')
+    ax.text(40, -0.07, "$r^2={:.2f}$".format(lm_lt25.rsquared_computed), ha='right')
+    ax.annotate("{:.2f}".format(lm_lt25.x_intercept), xy=(lm_lt25.x_intercept, 0), xytext=(30, -0.05),
+                arrowprops=dict(facecolor='black', arrowstyle="-|>"))
+    ax.set_title("10Y Stock - Bond Returns by CAPE")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('returns_by_inflation', ['df_10y'])
+def returns_by_inflation(prefs, df_10y):
+    fig, ax = plt.subplots()
+    inflation_bounds = [df_10y['forward_inflation'].min(), df_10y['forward_inflation'].max()]
+    for col, palette, label, offset in [('returns', prefs.s_palette, 'stock returns', 0),
+                                        ('gs10_returns', prefs.b_palette, 'bond returns', -0.02)]:
+        ax.scatter(df_10y['forward_inflation'], df_10y[col], alpha=0.5, color=palette[1], label=label)
+        lm = dsr.LinearModel('forward_inflation', col, df_10y, inflation_bounds).fit_and_predict()
+        ax.plot(inflation_bounds, lm.predictions, color=palette[0], alpha=0.95, lw=3.0,
+                label='{} regression'.format(label))
+        ax.text(inflation_bounds[1], lm.predictions[1] + offset, "$r^2={:.2f}$".format(lm.rsquared))
+    ax.set_ylabel("Annual Returns")
+    ax.set_xlabel("Forward Inflation")
+    ax.set_title("10Y Stock and Bond Returns by Inflation")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('returns_over_horizons', ['horizon_returns'])
+def returns_over_horizons(prefs, horizon_returns):
+    fig, axs = plt.subplots(2, 1, figsize=prefs.figure_small_size, sharex=True)
+    for ax, prefix, ylabel in [(axs[0], 'returns', "Annualized Returns"), (axs[1], 'gross_returns', "Gross Returns")]:
+        for horizon, color in zip([10, 15, 20], [prefs.s_palette[3], prefs.s_palette[1], prefs.s_palette[0]]):
+            col = '{}_{}y'.format(prefix, horizon)
+            ax.plot(horizon_returns.index, horizon_returns[col], color=color, alpha=0.9,
+                    label="{}Y returns".format(horizon))
+        ax.set_ylabel(ylabel)
+    axs[0].set_title("Stock Returns")
+    axs[0].legend()
+    dsr.cite_source(axs[1])
+    return fig
+
+
+@figure('returns_by_cape_over_horizons', ['horizon_returns', 'wr_curves'])
+def returns_by_cape_over_horizons(prefs, horizon_returns, wr_curves):
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(1, 3, figsize=(width * 2, height), sharex=True, sharey=True)
+    cape_range = wr_curves['cape'].values
+    for ax, horizon, color in zip(axs, [10, 15, 20], [3, 1, 0]):
+        returns = horizon_returns['returns_{}y'.format(horizon)]
+        curve = wr_curves['wr_{}y'.format(horizon)].values
+        ax.scatter(horizon_returns['cape'], returns, color=prefs.s_palette[color], alpha=0.7,
+                   label="{}y returns".format(horizon))
+        ax.plot(cape_range, curve, color=prefs.l_palette[0], alpha=0.9)
+        ss_res = np.sum(np.power(horizon_returns['wr_error_{}y'.format(horizon)], 2))
+        ss_tot = np.sum(np.power(returns - returns.mean(), 2))
+        ax.text(cape_range[-5], curve[-5] + 0.005, "$r^2={:.3f}$".format(1 - (ss_res / ss_tot)))
+        ax.set_xlabel("CAPE")
+        ax.legend()
+    axs[0].set_ylabel("Returns")
+    axs[1].set_title("Stock Returns over 10, 15, and 20 Years")
+    dsr.cite_source(axs[-1])
+    return fig
+
+
+@figure('wr_error_over_horizons', ['horizon_returns'])
+def wr_error_over_horizons(prefs, horizon_returns):
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(1, 3, figsize=(width * 2, height), sharex=True, sharey=True)
+    for ax, horizon, color in zip(axs, [10, 15, 20], [3, 1, 0]):
+        error = horizon_returns['wr_error_{}y'.format(horizon)]
+        ax.scatter(horizon_returns['cape'], error, color=prefs.s_palette[color], alpha=0.7,
+                   label="{}y returns".format(horizon))
+        error_mean = error.mean()
+        error_stddev = error.std()
+        ax.axhline(error_mean, alpha=0.9, color=prefs.l_palette[0], label='error mean')
+        ax.axhspan(error_mean - error_stddev, error_mean + error_stddev, color=prefs.l_palette[1], alpha=0.3,
+                   label="error +/- stddev")
+        ax.text(40, error_mean, "{:.3f}".format(error_mean))
+        ax.set_xlabel("CAPE")
+        ax.legend()
+    axs[0].set_ylabel("Acutal Returns - Warranted Returns")
+    axs[1].set_title("Warrented Return Errors over 10, 15, and 20 Years")
+    dsr.cite_source(axs[-1])
+    return fig
+
+
+@figure('loss_periods', ['horizon_returns', 'wr_curves'])
+def loss_periods(prefs, horizon_returns, wr_curves):
+    horizons = [10, 15, 20]
+    colors = [prefs.l_palette[i] for i in [3, 1, 0]]
+    limits = _gross_limits(horizon_returns)
+    losses = horizon_returns.loc[dsr.loss_indices(*[_stocks_df(horizon_returns, h) for h in horizons])]
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(1, 2, figsize=(width * 2, height))
+    for horizon, color in zip(horizons, colors):
+        col = 'gross_returns_{}y'.format(horizon)
+        axs[0].scatter(losses.index, losses[col], color=color, alpha=0.7, label="{}Y returns".format(horizon))
+        axs[1].scatter(losses['cape'], losses[col], color=color, alpha=0.7, label="{}Y returns".format(horizon))
+        axs[1].plot(wr_curves['cape'], wr_curves['gross_wr_{}y'.format(horizon)], color=color, alpha=0.7, lw=3,
+                    label='{}Y warranted returns'.format(horizon))
+    axs[0].set_ylabel("Gross Returns")
+    axs[1].set_xlim([horizon_returns['cape'].min(), horizon_returns['cape'].max()])
+    for ax in axs:
+        ax.set_ylim(limits)
+    axs[1].legend()
+    fig.suptitle("Gross Returns in Loss Periods")
+    dsr.cite_source(axs[1])
+    return fig
+
+
+@figure('inversion_periods', ['horizon_returns'])
+def inversion_periods(prefs, horizon_returns):
+    colors = {10: prefs.l_palette[3], 15: prefs.l_palette[1], 20: prefs.l_palette[0]}
+    limits = _gross_limits(horizon_returns)
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(3, 2, figsize=(width * 2, height * 1.5))
+    for ax_row, pair in zip(axs, [(10, 15), (10, 20), (15, 20)]):
+        cols = ['gross_returns_{}y'.format(h) for h in pair]
+        inverted = horizon_returns.loc[dsr.inversion_indices(_stocks_df(horizon_returns, pair[0]),
+                                                             _stocks_df(horizon_returns, pair[1]), 'gross_returns')]
+        for col, horizon, size in zip(cols, pair, [30, 25]):
+            label = "{}Y returns".format(horizon)
+            ax_row[0].scatter(inverted.index, inverted[col], color=colors[horizon], alpha=0.5, s=size, label=label)
+            ax_row[1].scatter(inverted['cape'], inverted[col], color=colors[horizon], alpha=0.5, s=size, label=label)
+        ax_row[0].set_ylabel("Gross Returns")
+        ax_row[1].set_xlim([horizon_returns['cape'].min(), horizon_returns['cape'].max()])
+        for ax in ax_row:
+            ax.set_ylim(limits)
+        ax_row[1].legend()
+    axs[-1][0].set_xlabel("Date")
+    axs[-1][1].set_xlabel("CAPE")
+    fig.suptitle("Gross Returns in Periods of Inversion")
+    dsr.cite_source(axs[-1][1])
+    return fig
+
+
+@figure('waiting_returns', ['wait_returns', 'wr_curves'])
+def waiting_returns(prefs, wait_returns, wr_curves):
+    horizons = [10, 15, 20]
+    waits = [1, 2, 3]
+    cape_range = wr_curves['cape'].values
+    cape = wait_returns[('cape', 0)]
+    diffs = wait_returns[horizons]
+    limits = [diffs.min().min(), diffs.max().max()]
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(len(horizons), len(waits), figsize=(width * 2, height * 2), sharex=True, sharey=True)
+    for ax_row, horizon, color in zip(axs, horizons, [prefs.s_palette[i] for i in [3, 1, 0]]):
+        for ax, wait in zip(ax_row, waits):
+            diff = wait_returns[(horizon, wait)]
+            ax.scatter(cape, diff, color=color, alpha=0.3, label="{}y horizon".format(horizon))
+            ldf = pd.DataFrame({'diff': diff, 'cape': cape}).dropna()
+            lm = dsr.LinearModel('cape', 'diff', ldf, [cape_range[0], cape_range[-1]]).fit_and_predict()
+            ax.plot(lm.pred_range, lm.predictions, color=prefs.l_palette[0], alpha=0.9, lw=3.0, label="regression")
+            ax.text(lm.pred_range[1] - 5, lm.predictions[1], "$r^2={:.2f}$".format(lm.rsquared))
+            ax.axhline(diff.median(), color=prefs.l_palette[1], alpha=0.9, label="median")
+            ax.set_title("Horizon {}y | Wait {}y".format(horizon, wait))
+            ax.set_ylim(limits)
+        ax_row[0].set_ylabel("Gross Returns Difference")
+        ax_row[-1].legend()
+    for ax in axs[-1]:
+        ax.set_xlabel("CAPE")
+    return fig
+
+
+@figure('predictions_10y', ['df_10y', 'predictions_10y', 'wr_curves'])
+def predictions_10y(prefs, df_10y, predictions_10y, wr_curves):
+    fig, ax = plt.subplots()
+    _plot_predictions(ax, prefs, df_10y['cape'], df_10y['returns'],
+                      predictions_10y.rename(columns={'returns': 'prediction'}))
+    ax.plot(wr_curves['cape'], wr_curves['wr_10y'], color=prefs.l_palette[0], alpha=0.9)
+    ax.set_ylabel("Annual Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10-Year Stock Returns")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('stock_bond_diff_predictions_10y', ['stock_bond_diff'])
+def stock_bond_diff_predictions_10y(prefs, stock_bond_diff):
+    fig, ax = plt.subplots()
+    predictions = stock_bond_diff[stock_bond_diff['prediction'].notnull()]
+    _plot_predictions(ax, prefs, stock_bond_diff['cape'], stock_bond_diff['stocks_bonds_diff'], predictions)
+    ax.axhline(0, color=prefs.l_palette[1], alpha=0.9, label="Stocks >= Bonds")
+    ax.set_ylabel("Stock - Bond Returns")
+    ax.set_xlabel("CAPE")
+    ax.set_title("10-Year Stock, Bond Returns Difference")
+    ax.legend()
+    dsr.cite_source(ax)
+    return fig
+
+
+@figure('predictions_over_horizons', ['horizon_returns', 'horizon_predictions', 'wr_curves'])
+def predictions_over_horizons(prefs, horizon_returns, horizon_predictions, wr_curves):
+    width, height = prefs.figure_full_size
+    fig, axs = plt.subplots(1, 3, figsize=(width * 2, height))
+    returns = horizon_returns[['returns_{}y'.format(h) for h in [10, 15, 20]]]
+    for ax, horizon, num_labels in zip(axs, [10, 15, 20], [3, 1, 1]):
+        col = 'returns_{}y'.format(horizon)
+        predictions = horizon_predictions[['cape', col]].rename(columns={col: 'prediction'})
+        _plot_predictions(ax, prefs, horizon_returns['cape'], horizon_returns[col], predictions,
+                          num_labels=num_labels)
+        ax.plot(wr_curves['cape'], wr_curves['wr_10y'], color=prefs.l_palette[0], alpha=0.9)
+        ax.set_ylim([returns.min().min(), returns.max().max()])
+        ax.set_xlabel("CAPE")
+        ax.set_title("{}-Year Stock Returns".format(horizon))
+    axs[0].set_ylabel("Annual Returns")
+    axs[-1].legend()
+    dsr.cite_source(axs[-1])
+    return fig
+
+
+# Building
+
+def _hash_input(digest, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = value.columns if isinstance(value, pd.DataFrame) else value.name
+        digest.update(repr(labels).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype, value.shape)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(repr(value).encode('utf-8'))
+
+
+def figure_key(name, inputs, prefs, fmt):
+    """Return a hash of everything that determines the output of figure name in format fmt."""
+    _, input_names = FIGURES[name]
+    digest = hashlib.sha256()
+    digest.update(repr((name, fmt, sorted(vars(prefs).items()))).encode('utf-8'))
+    # Figures use the helpers here and in dsr, so any change to either module invalidates them
+    for module in [sys.modules[__name__], dsr]:
+        digest.update(inspect.getsource(module).encode('utf-8'))
+    for input_name in input_names:
+        digest.update(input_name.encode('utf-8'))
+        _hash_input(digest, inputs[input_name])
+    return digest.hexdigest()
+
+
+def _use_agg():
+    plt.switch_backend('Agg')
+
+
+def _render(name, inputs, prefs, paths):
+    """Render figure name to each of paths with the current backend."""
+    prefs.use()
+    func, _ = FIGURES[name]
+    fig = func(prefs, **inputs)
+    for path in paths:
+        fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return name
+
+
+def build_figures(stockscape_data, out_dir, names=None, formats=('png',), prefs=None, jobs=None, log=None):
+    """Render the figures in names (defaults to all) into out_dir, skipping those whose inputs are unchanged.
+
+    :param stockscape_data: A data_series.StockscapeData object.
+    :param out_dir: The folder to write figures to. A manifest of hashes is kept there as well.
+    :param names: The names of the figures to build
+    :param formats: The file formats (extensions) to write, e.g., ('png', 'svg')
+    :param prefs: A DsrStylePrefs object, defaults to DsrStylePrefs()
+    :param jobs: The maximum number of figures to render concurrently. Defaults to the number of CPUs.
+    :param log: A function called with a status line for each figure. Defaults to doing nothing.
+    :return: A dict of figure name to True if it was rendered, False if it was up to date.
+    """
+    names = list(FIGURES.keys()) if names is None else names
+    prefs = prefs if prefs else dsr.DsrStylePrefs()
+    log = log if log else (lambda line: None)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, 'figures.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    needed = sorted({i for name in names for i in FIGURES[name][1]})
+    inputs = {i: INPUTS[i](stockscape_data) for i in needed}
+
+    stale = {}
+    for name in names:
+        figure_inputs = {i: inputs[i] for i in FIGURES[name][1]}
+        keys = {fmt: figure_key(name, figure_inputs, prefs, fmt) for fmt in formats}
+        paths = {fmt: os.path.join(out_dir, "{}.{}".format(name, fmt)) for fmt in formats}
+        if all(manifest.get(os.path.basename(paths[fmt])) == keys[fmt] and os.path.exists(paths[fmt])
+               for fmt in formats):
+            log("{}: unchanged".format(name))
+        else:
+            stale[name] = (figure_inputs, paths, keys)
+
+    if jobs == 1 or len(stale) < 2:
+        # Keep the caller's backend and restore its style afterwards
+        with plt.rc_context():
+            rendered = [_render(name, i, prefs, list(p.values())) for name, (i, p, _) in stale.items()]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_use_agg) as executor:
+            futures = [executor.submit(_render, name, i, prefs, list(p.values())) for name, (i, p, _) in stale.items()]
+            rendered = [f.result() for f in futures]
+
+    for name in rendered:
+        _, paths, keys = stale[name]
+        for fmt in formats:
+            manifest[os.path.basename(paths[fmt])] = keys[fmt]
+        log("{}: rendered".format(name))
+    atomic_write(manifest_path, json.dumps(manifest, indent=2, sort_keys=True), 'w')
+    return {name: name in stale for name in names}
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+kernels.py
+
+Numerical kernels for the loop-shaped work in the analysis: forward products, rolling summaries,
+nearest-neighbor selection, and run detection.
+
+There are two backends with the same interface: NumpyKernels, the reference implementation and the
+default, and NumbaKernels (in _numba_kernels.py), which compiles the rolling median with numba. The
+numba backend only pays off for long rolling-median windows (e.g., CAPE on daily data) and importing
+numba adds about half a second to the start of every process, so it has to be chosen explicitly: set
+the environment variable STOCKSCAPE_KERNELS to 'numba', or call set_backend('numba').
+
+Created by Chandrasekhar Ramakrishnan on 2017-12-11.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import os
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class NumpyKernels(object):
+    """Reference implementations of the kernels using numpy."""
+
+    name = 'numpy'
+
+    @staticmethod
+    def forward_product(values, periods):
+        """Return the product of the periods values following each position.
+
+        result[t] = values[t + 1] * ... * values[t + periods]. Like pandas rolling(periods, 1).apply(np.prod),
+        nans are skipped; products without any values, or that extend past the end of values, are nan.
+        Computed in O(n) from prefix sums of log magnitudes and counts of nans, zeros, and negative values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        result = np.full(len(values), np.nan)
+        if periods >= len(values):
+            return result
+        present = ~np.isnan(values)
+        magnitudes = np.abs(values[present])
+        logs = np.zeros(len(values))
+        with np.errstate(divide='ignore'):
+            logs[present] = np.log(np.where(magnitudes > 0, magnitudes, 1))
+
+        def window_sums(x):
+            prefix = np.concatenate([[0], np.cumsum(x)])
+            return prefix[periods + 1:] - prefix[1:len(prefix) - periods]
+
+        counts = window_sums(present.astype(np.int64))
+        zeros = window_sums(present & (values == 0))
+        negatives = window_sums(present & (values < 0))
+        products = np.where(negatives % 2, -1.0, 1.0) * np.exp(window_sums(logs))
+        products[zeros > 0] = 0
+        products[counts == 0] = np.nan
+        result[0:len(values) - periods] = products
+        return result
+
+    @staticmethod
+    def rolling_summary(values, window, summary='mean'):
+        """Return the mean or median of the window values up to and including each position.
+
+        Like pandas rolling(window, 1): nans are ignored and windows at the start may be shorter.
+        Windows without any values are nan. The mean is computed in O(n) from prefix sums; the median
+        materializes each window, so its memory grows with n * window.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if summary == 'mean':
+            present = ~np.isnan(values)
+            sums = np.concatenate([[0], np.cumsum(np.where(present, values, 0))])
+            counts = np.concatenate([[0], np.cumsum(present)])
+            starts = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+            window_counts = counts[1:] - counts[starts]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = (sums[1:] - sums[starts]) / window_counts
+            means[window_counts == 0] = np.nan
+            return means
+        padded = np.concatenate([np.full(window - 1, np.nan), values])
+        windows = sliding_window_view(padded, window)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return np.nanmedian(windows, axis=1)
+
+    @staticmethod
+    def smallest_k(matrix, k):
+        """Return, for each row of matrix, the column indices of the k smallest values in ascending order.
+
+        Ties are broken by column index and nans are treated as infinite. Each row is partitioned, so only
+        the k selected values are sorted.
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        rows, columns = matrix.shape
+        k = max(0, min(k, columns))
+        if k == columns:
+            return np.argsort(np.where(np.isnan(matrix), np.inf, matrix), axis=1, kind='mergesort')
+        if k == 0:
+            return np.zeros((rows, 0), dtype=np.int64)
+        keys = np.where(np.isnan(matrix), np.inf, matrix)
+        kth = np.partition(keys, k - 1, axis=1)[:, k - 1:k]
+        below = keys < kth
+        equal = keys == kth
+        # Of the columns equal to the k-th smallest value, take the first ones needed to make up k
+        selected = below | (equal & (np.cumsum(equal, axis=1) <= k - below.sum(axis=1, keepdims=True)))
+        positions = np.nonzero(selected)[1].reshape(rows, k)
+        order = np.argsort(np.take_along_axis(keys, positions, axis=1), axis=1, kind='mergesort')
+        return np.take_along_axis(positions, order, axis=1)
+
+    @staticmethod
+    def run_starts(values):
+        """Return the positions at which a run of consecutive integers starts (always including 0)."""
+        values = np.asarray(values, dtype=np.int64)
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([[0], np.flatnonzero(values[1:] != values[:-1] + 1) + 1])
+
+
+_backend = None
+
+
+def available_backends():
+    """Return the names of the backends that can be used."""
+    names = ['numpy']
+    try:
+        import numba  # noqa: F401
+        names.append('numba')
+    except ImportError:
+        pass
+    return names
+
+
+def load_backend(name):
+    """Return the kernels object for the backend name ('numpy' or 'numba')."""
+    if name == 'numpy':
+        return NumpyKernels
+    if name == 'numba':
+        from ._numba_kernels import NumbaKernels
+        return NumbaKernels
+    raise ValueError("Unknown kernel backend {}".format(name))
+
+
+def set_backend(name=None):
+    """Use the backend name for the kernel functions in this module. None uses STOCKSCAPE_KERNELS, or numpy."""
+    global _backend
+    if name is None:
+        name = os.environ.get('STOCKSCAPE_KERNELS') or 'numpy'
+    _backend = load_backend(name)
+    return _backend
+
+
+def get_backend():
+    """Return the kernels object in use, choosing one on first use."""
+    return _backend if _backend is not None else set_backend()
+
+
+def forward_product(values, periods):
+    return get_backend().forward_product(values, periods)
+
+
+def rolling_summary(values, window, summary='mean'):
+    return get_backend().rolling_summary(values, window, summary)
+
+
+def smallest_k(matrix, k):
+    return get_backend().smallest_k(matrix, k)
+
+
+def run_starts(values):
+    return get_backend().run_starts(values)
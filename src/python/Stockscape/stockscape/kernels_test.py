@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+kernels_test.py
+
+Check the kernel backends against pandas and against each other.
+
+Created by Chandrasekhar Ramakrishnan on 2017-12-11.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from . import kernels
+
+
+def backends():
+    return [kernels.load_backend(name) for name in kernels.available_backends()]
+
+
+@pytest.fixture(scope="module")
+def values():
+    rng = np.random.RandomState(17)
+    values = 1 + rng.normal(0, 0.02, 500)
+    values[[0, 100, 101, 450]] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('backend', backends(), ids=lambda b: b.name)
+def test_forward_product(backend, values):
+    # The expression StockReturns used before the kernels: nans are skipped
+    expected = pd.Series(values).rolling(24, 1).apply(np.prod, raw=False).shift(-24)
+    assert np.allclose(backend.forward_product(values, 24), expected, equal_nan=True)
+    signed = values.copy()
+    signed[[10, 20]] = [-2, 0]
+    expected = pd.Series(signed).rolling(24, 1).apply(np.prod, raw=False).shift(-24)
+    assert np.allclose(backend.forward_product(signed, 24), expected, equal_nan=True)
+    assert np.isnan(backend.forward_product(np.full(30, np.nan), 24)).all()
+
+
+@pytest.mark.parametrize('backend', backends(), ids=lambda b: b.name)
+@pytest.mark.parametrize('summary', ['mean', 'median'])
+def test_rolling_summary(backend, summary, values):
+    expected = getattr(pd.Series(values).rolling(120, 1), summary)()
+    assert np.allclose(backend.rolling_summary(values, 120, summary), expected, equal_nan=True)
+
+
+@pytest.mark.parametrize('backend', backends(), ids=lambda b: b.name)
+def test_smallest_k(backend, values):
+    matrix = np.abs(np.subtract.outer(values[200:260], values[300:400]))
+    positions = backend.smallest_k(matrix, 7)
+    assert positions.shape == (60, 7)
+    for row, row_positions in zip(matrix, positions):
+        assert (row[row_positions] == np.sort(row)[0:7]).all()
+    assert (positions == kernels.NumpyKernels.smallest_k(matrix, 7)).all()
+    # Ties are broken by column index
+    ties = np.round(matrix, 2)
+    expected = np.argsort(np.where(np.isnan(ties), np.inf, ties), axis=1, kind='mergesort')[:, 0:7]
+    assert (backend.smallest_k(ties, 7) == expected).all()
+
+
+def test_default_backend(monkeypatch):
+    monkeypatch.delenv('STOCKSCAPE_KERNELS', raising=False)
+    assert kernels.set_backend().name == 'numpy'
+
+
+@pytest.mark.parametrize('backend', backends(), ids=lambda b: b.name)
+def test_run_starts(backend):
+    years = np.array([1901, 1902, 1903, 1929, 1930, 1966, 1999, 2000])
+    assert list(backend.run_starts(years)) == [0, 3, 5, 6]
+    assert list(backend.run_starts(years[0:1])) == [0]
+    assert len(backend.run_starts(years[0:0])) == 0
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+loadtest.py
+
+Measure the throughput and latency of a stockscape server (see server.py) on keep-alive connections.
+
+  python -m stockscape.loadtest http://127.0.0.1:8080/data.json --requests 10000 --concurrency 32 [--gzip] [--etag]
+
+With --etag, the clients send the ETag of the first response in If-None-Match, so the server answers 304.
+
+Created by Chandrasekhar Ramakrishnan on 2018-01-08.
+Copyright (c) 2018 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+async def fetch(reader, writer, host, path, headers=None):
+    """Send a GET on an open connection and return (status, headers, body)."""
+    lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host)]
+    lines.extend('{}: {}'.format(name, value) for name, value in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    response_headers = {}
+    for line in head[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(response_headers.get('content-length', 0)))
+    return int(head[0].split(' ')[1]), response_headers, body
+
+
+async def run_client(host, port, path, headers, count, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            await fetch(reader, writer, host, path, headers)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def load_test(url, requests=10000, concurrency=32, gzip=False, etag=False):
+    """Issue requests GETs to url over concurrency connections and return a dict of statistics."""
+    parts = urlsplit(url)
+    host, port, path = parts.hostname, parts.port or 80, parts.path or '/'
+    headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+    reader, writer = await asyncio.open_connection(host, port)
+    status, response_headers, body = await fetch(reader, writer, host, path, headers)
+    writer.close()
+    if etag:
+        headers['If-None-Match'] = response_headers['etag']
+
+    latencies = []
+    counts = [len(a) for a in np.array_split(np.arange(requests), concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(host, port, path, headers, count, latencies) for count in counts])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies), 'seconds': elapsed, 'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': np.percentile(latencies, 50), 'p99_ms': np.percentile(latencies, 99),
+        'max_ms': latencies.max(), 'body_bytes': len(body)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a stockscape server.")
+    parser.add_argument('url', help="The URL to request, e.g., http://127.0.0.1:8080/data.json")
+    parser.add_argument('--requests', '-n', type=int, default=10000, help="The total number of requests")
+    parser.add_argument('--concurrency', '-c', type=int, default=32, help="The number of connections")
+    parser.add_argument('--gzip', action='store_true', help="Ask for gzip-compressed responses")
+    parser.add_argument('--etag', action='store_true', help="Send If-None-Match with the current ETag")
+    args = parser.parse_args(argv)
+    stats = asyncio.run(load_test(args.url, args.requests, args.concurrency, args.gzip, args.etag))
+    print("{requests} requests in {seconds:.2f}s: {requests_per_second:.0f} req/s, "
+          "p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms ({body_bytes} byte body)".format(**stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
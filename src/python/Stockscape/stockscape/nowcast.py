@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+nowcast.py
+
+Compute the current CAPE and warranted returns from a stream of price ticks.
+
+The trailing earnings summary only changes when a new monthly row arrives, so each price tick is a
+constant-time update.
+
+Created by Chandrasekhar Ramakrishnan on 2017-11-13.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import asyncio
+import bisect
+import csv
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+PriceTick = namedtuple('PriceTick', ['time', 'price'])
+PriceTick.__doc__ = """A nominal price observation."""
+
+EarningsRow = namedtuple('EarningsRow', ['date', 'earnings', 'cpi'])
+EarningsRow.__doc__ = """Nominal earnings and CPI for the next month, as found in a row of the ie_data file.
+
+Either may be nan: the latest rows of the ie_data file have a CPI but no earnings yet."""
+
+Nowcast = namedtuple('Nowcast', ['time', 'price', 'cape', 'gross_warranted_returns', 'warranted_returns'])
+Nowcast.__doc__ = """The CAPE and warranted returns (gross and annualized) implied by a price tick."""
+
+
+class CapeNowcast(object):
+    """Keep the trailing earnings summary needed to compute CAPE from live prices.
+
+    Like Cape, the summary covers the years * 12 months before the current month, skipping months without
+    earnings. Earnings for a month are only known once it is over, so the current month is the month after
+    the latest earnings, or the latest month with a CPI if that is later. Prices are converted to real units
+    using the latest CPI.
+    """
+
+    def __init__(self, real_stock_data, years=10, summary='mean', returns_years=10):
+        """Initialize the CapeNowcast object.
+        :param real_stock_data: A data_series.RealStockData object with the history to start from.
+        :param years: The period to look at when computing CAPE, specified in years. Defaults to 10 years.
+        :param summary: The summary statistic to use: 'mean' or 'median'. Default is 'mean'.
+        :param returns_years: The period over which warranted returns are calculated. Defaults to 10 years.
+        """
+        self.years = years
+        self.months = years * 12
+        self.summary = summary
+        self.returns_years = returns_years
+        self.base_price_level = real_stock_data.base_price_level
+
+        # Months are counted by their row in the history
+        earnings = real_stock_data.df['earnings']
+        cpi = real_stock_data.cpi_s.reindex(earnings.index)
+        self.date = earnings.index[-1]
+        self.cpi = cpi.dropna().iloc[-1]
+        self.last_row = len(earnings) - 1
+        self.last_earnings_row = int(np.flatnonzero(earnings.notnull().values)[-1])
+        self.last_cpi_row = int(np.flatnonzero(cpi.notnull().values)[-1])
+        current = self._current_row()
+        values = earnings.values[max(current - self.months, 0):current]
+        # The window holds the earnings (nan if missing) of the months before the current one. The earnings of
+        # the current month and later rows wait in pending.
+        self.window = deque(np.concatenate([np.full(self.months - len(values), np.nan), values]))
+        self.pending = deque(earnings.values[current:])
+        present = [e for e in self.window if not np.isnan(e)]
+        self.earnings_sum = sum(present)
+        self.earnings_count = len(present)
+        self.sorted_earnings = sorted(present)
+        self.earnings_summary = None
+        self._update_summary()
+
+    def _current_row(self):
+        return max(self.last_earnings_row + 1, self.last_cpi_row)
+
+    def _update_summary(self):
+        if self.earnings_count == 0:
+            self.earnings_summary = np.nan
+        elif self.summary == 'mean':
+            self.earnings_summary = self.earnings_sum / self.earnings_count
+        else:
+            n = len(self.sorted_earnings)
+            mid = n // 2
+            if n % 2:
+                self.earnings_summary = self.sorted_earnings[mid]
+            else:
+                self.earnings_summary = (self.sorted_earnings[mid - 1] + self.sorted_earnings[mid]) / 2
+
+    def _advance(self):
+        """Move the oldest pending month into the window, dropping the oldest month of the window."""
+        earnings = self.pending.popleft()
+        self.window.append(earnings)
+        if not np.isnan(earnings):
+            self.earnings_sum += earnings
+            self.earnings_count += 1
+            bisect.insort(self.sorted_earnings, earnings)
+        oldest = self.window.popleft()
+        if not np.isnan(oldest):
+            self.earnings_sum -= oldest
+            self.earnings_count -= 1
+            del self.sorted_earnings[bisect.bisect_left(self.sorted_earnings, oldest)]
+
+    def roll(self, row):
+        """Add the row for the next month, moving the window forward if the current month changes.
+        :param row: An EarningsRow with nominal earnings and the CPI for the month, either of which may be nan
+        """
+        self.last_row += 1
+        has_earnings = not np.isnan(row.earnings)
+        self.pending.append(row.earnings * self.base_price_level / row.cpi if has_earnings else np.nan)
+        if has_earnings:
+            self.last_earnings_row = self.last_row
+        if not np.isnan(row.cpi):
+            self.cpi = row.cpi
+            self.last_cpi_row = self.last_row
+        current = self._current_row()
+        while self.last_row + 1 - len(self.pending) < current:
+            self._advance()
+        self.date = pd.Timestamp(row.date)
+        self._update_summary()
+
+    def update(self, tick):
+        """Return the Nowcast for a price tick.
+        :param tick: A PriceTick with a nominal price
+        :return: A Nowcast
+        """
+        cape = (tick.price * self.base_price_level / self.cpi) / self.earnings_summary
+        gross_wr = (1 + 1 / cape) ** self.returns_years - 1
+        wr = (1 + gross_wr) ** (1 / self.returns_years) - 1
+        return Nowcast(tick.time, tick.price, cape, gross_wr, wr)
+
+    async def stream(self, ticks):
+        """Consume an async iterator of PriceTick and EarningsRow objects, yielding a Nowcast for each price tick.
+
+        EarningsRow objects roll the window forward and do not produce output.
+        """
+        async for tick in ticks:
+            if isinstance(tick, EarningsRow):
+                self.roll(tick)
+            else:
+                yield self.update(tick)
+
+
+async def read_tick_file(path, speed=None):
+    """Replay a CSV file of ticks as an async iterator.
+
+    The file has the columns time, price, earnings, cpi. Rows with earnings or a CPI are EarningsRow objects
+    (the price is ignored), all other rows are PriceTick objects.
+    :param path: The path to the tick file
+    :param speed: If given, wait between ticks for the time between them divided by speed
+    """
+    last_time = None
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            time = pd.Timestamp(row['time'])
+            if speed and last_time is not None:
+                await asyncio.sleep(max((time - last_time).total_seconds() / speed, 0))
+            else:
+                await asyncio.sleep(0)
+            last_time = time
+            if row.get('earnings') or row.get('cpi'):
+                yield EarningsRow(time, float(row['earnings'] or 'nan'), float(row['cpi'] or 'nan'))
+            else:
+                yield PriceTick(time, float(row['price']))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+percentiles.py
+
+Answer questions about where values fall in history, e.g., "the current CAPE is in the 97th percentile".
+
+Full-history queries use a sorted array. Point-in-time (as-of-date) queries only consider the values that
+were known at the date. The values known at a date are a prefix of the series in time order, so these
+queries are answered by a merge-sort tree over the series, built once: O(log^2 n) for a percentile rank and
+O(log^3 n) for a quantile.
+
+Created by Chandrasekhar Ramakrishnan on 2017-11-20.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class MergeSortTree(object):
+    """Count, within any prefix of a sequence of integer keys in [0, n), the keys below a threshold.
+
+    Level l holds the keys sorted within consecutive blocks of 2**l positions. A prefix is the union of at
+    most one block per level, so a count takes one binary search per level: O(log^2 n) per query. Queries
+    are vectorized over arrays of prefix lengths and thresholds.
+    """
+
+    def __init__(self, keys):
+        """
+        :param keys: An array of n distinct integers in [0, n)
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        self.size = len(keys)
+        # Keys are offset by block * base, so one binary search over a whole level stays within a block.
+        # Padding uses the key n, which is never below a threshold.
+        self.base = self.size + 1
+        padded = np.full(1 << max(0, (self.size - 1).bit_length()), self.size, dtype=np.int64)
+        padded[0:self.size] = keys
+        self.levels = []
+        width = 1
+        while width <= len(padded):
+            blocks = np.sort(padded.reshape(-1, width), axis=1)
+            self.levels.append((blocks + np.arange(len(blocks))[:, np.newaxis] * self.base).ravel())
+            width *= 2
+
+    def count_below(self, prefix_lengths, thresholds):
+        """Return the number of keys below thresholds among the first prefix_lengths keys (1-d arrays)."""
+        prefix_lengths = np.asarray(prefix_lengths, dtype=np.int64)
+        thresholds = np.asarray(thresholds, dtype=np.int64)
+        counts = np.zeros(len(prefix_lengths), dtype=np.int64)
+        starts = np.zeros(len(prefix_lengths), dtype=np.int64)
+        for level in reversed(range(len(self.levels))):
+            width = 1 << level
+            take = prefix_lengths - starts >= width
+            if not take.any():
+                continue
+            blocks = starts[take] >> level
+            found = np.searchsorted(self.levels[level], blocks * self.base + thresholds[take], side='left')
+            counts[take] += found - blocks * width
+            starts[take] += width
+        return counts
+
+    def find_kth(self, prefix_lengths, k):
+        """Return the k-th (0-based) smallest key among the first prefix_lengths keys (1-d arrays).
+
+        Requires k < prefix_lengths. Binary searches over the keys, so a query is O(log^3 n).
+        """
+        k = np.asarray(k, dtype=np.int64)
+        lo = np.zeros(len(k), dtype=np.int64)
+        hi = np.full(len(k), max(self.size - 1, 0), dtype=np.int64)
+        while (lo < hi).any():
+            mid = (lo + hi) // 2
+            above = self.count_below(prefix_lengths, mid + 1) > k
+            hi = np.where(above, mid, hi)
+            lo = np.where(above, lo, mid + 1)
+        return lo
+
+
+class PercentileIndex(object):
+    """Percentile ranks and quantiles of a series over its full history or as of a date."""
+
+    def __init__(self, ser, lag_months=0):
+        """Initialize the PercentileIndex object.
+        :param ser: A series indexed by date. Missing values are ignored.
+        :param lag_months: The number of months after its date at which a value becomes known. For example,
+                           returns over 10 years are only known 120 months after their date.
+        """
+        self.ser = ser.dropna()
+        self.lag_months = lag_months
+        self.available = (self.ser.index + pd.DateOffset(months=lag_months)).values
+        values = self.ser.values
+        # Each value gets its own slot in the sorted order, so the tree can count values below a threshold.
+        order = np.argsort(values, kind='mergesort')
+        self.sorted_values = values[order]
+        self.slots = np.empty(len(order), dtype=np.int64)
+        self.slots[order] = np.arange(len(order))
+        self.tree = MergeSortTree(self.slots)
+
+    @classmethod
+    def from_cape(cls, cape):
+        """Return an index over the CAPE values of a Cape object."""
+        return cls(cape.df['cape'])
+
+    @classmethod
+    def from_stock_returns(cls, stock_returns, column='returns'):
+        """Return an index over a column of a StockReturns object. Values become known at the end of the period."""
+        return cls(stock_returns.df[column], stock_returns.period_utils.months)
+
+    def __len__(self):
+        return len(self.sorted_values)
+
+    def percentile_rank(self, values, kind='weak'):
+        """Return the percentage of the full history that is below values.
+        :param values: A value or array of values
+        :param kind: 'weak' counts values <= value, 'strict' counts values < value
+        :return: Percentile ranks from 0 to 100
+        """
+        counts = np.searchsorted(self.sorted_values, values, side=self._side(kind))
+        return 100.0 * counts / len(self)
+
+    def quantile(self, q):
+        """Return the q-quantile (0 <= q <= 1) of the full history, interpolating linearly like numpy."""
+        pos = np.asarray(q, dtype=np.float64) * (len(self) - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        return self._interpolate(self.sorted_values[lo], self.sorted_values[hi], pos - lo)
+
+    def percentile_rank_as_of(self, values, dates, kind='weak'):
+        """Return the percentage of the history known at dates that is below values.
+
+        values and dates are broadcast against each other.
+        :param values: A value or array of values
+        :param dates: A date or array of dates
+        :param kind: 'weak' counts values <= value, 'strict' counts values < value
+        :return: Percentile ranks from 0 to 100, nan where no history is known
+        """
+        values, known = np.broadcast_arrays(np.asarray(values, dtype=np.float64), self._known_counts(dates))
+        thresholds = np.searchsorted(self.sorted_values, values, side=self._side(kind))
+        counts = self.tree.count_below(known.ravel(), thresholds.ravel()).reshape(known.shape)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(known > 0, 100.0 * counts / known, np.nan)
+
+    def quantile_as_of(self, q, dates):
+        """Return the q-quantile (0 <= q <= 1) of the history known at dates.
+
+        q and dates are broadcast against each other.
+        :return: The quantiles, nan where no history is known
+        """
+        q, known = np.broadcast_arrays(np.asarray(q, dtype=np.float64), self._known_counts(dates))
+        pos = q * np.maximum(known - 1, 0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        flat_known = np.maximum(known.ravel(), 1)
+        lo_values = self.sorted_values[self.tree.find_kth(flat_known, lo.ravel())].reshape(known.shape)
+        hi_values = self.sorted_values[self.tree.find_kth(flat_known, hi.ravel())].reshape(known.shape)
+        return np.where(known > 0, self._interpolate(lo_values, hi_values, pos - lo), np.nan)
+
+    def point_in_time_ranks(self, kind='weak'):
+        """Return a series with the percentile rank of each value among the values known at its date."""
+        ranks = self.percentile_rank_as_of(self.ser.values, self.ser.index.values, kind)
+        return pd.Series(ranks, index=self.ser.index, name=self.ser.name)
+
+    def _known_counts(self, dates):
+        """Return the number of values known at each of the dates."""
+        dates = np.asarray(dates)
+        dates = pd.to_datetime(dates.ravel()).values.reshape(dates.shape)
+        return np.searchsorted(self.available, dates, side='right')
+
+    @staticmethod
+    def _interpolate(lo_values, hi_values, fraction):
+        return lo_values + (hi_values - lo_values) * fraction
+
+    @staticmethod
+    def _side(kind):
+        if kind not in ('weak', 'strict'):
+            raise ValueError("kind must be 'weak' or 'strict', not {}".format(kind))
+        return 'right' if kind == 'weak' else 'left'
@@ -9,9 +9,18 @@ Created by Chandrasekhar Ramakrishnan on 2016-09-22.
 Copyright (c) 2016 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
+import asyncio
+import gzip
+import json
+import os
+import shutil
+
 from . import reader
-from . import analysis, returns, ui
+from . import analysis, build, chunked, data_series, loadtest, nowcast, percentiles, returns, server, snapshot
+from . import tuning, ui
 import numpy as np
+import pandas as pd
+import pytest
 
 
 # noinspection PyProtectedMember,SpellCheckingInspection
@@ -68,6 +77,367 @@ def test_price_calculation(shiller_excel_data_path):
     assert abs(predict_df.loc['2017-05', 'max'][0] - 0.051764) < 0.00001
 
 
+def test_stock_returns_last_valid_date(shiller_excel_data_path):
+    """The latest month has no dividend yet; it is skipped, so the last full period still has returns."""
+    data = reader.read_ie_data(shiller_excel_data_path)
+    assert np.isnan(data.real_stock_data.df['m_return'].iloc[-1])
+    for years in [10, 20]:
+        gross_returns = returns.StockReturns(data, years).df['gross_returns']
+        assert gross_returns.last_valid_index() == data.real_stock_data.df.index[-1 - years * 12]
+
+
 def test_export(tmpdir, shiller_excel_data_path):
     data = reader.read_ie_data(shiller_excel_data_path)
     ui.UiData(data).write(str(tmpdir.join("test.json")))
+
+
+def test_snapshot(tmpdir, shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    path = str(tmpdir.join("test.snap"))
+    snapshot.write_snapshot(data, path, horizons=[10, 20])
+    snap = snapshot.read_snapshot(path)
+    assert isinstance(snap.values, np.memmap)
+    assert 'stock_20y' in snap
+    assert 'cape_median_10y' in snap
+    cape = analysis.Cape(data)
+    assert (snap.index == cape.df.index).all()
+    assert np.allclose(snap['cape'], cape.df['cape'], equal_nan=True)
+    assert np.allclose(snap['cape_mean_10y'], cape.df['cape'], equal_nan=True)
+    assert abs(snap['stock_10y'].loc['2005-05'][0] - 0.060458) < 0.00001
+
+
+def test_walk_forward(shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    cape = analysis.Cape(data)
+    stock_returns = returns.StockReturns(data)
+    walk_forward = analysis.CapeNeighborsWalkForward(cape, stock_returns.df, 'gross_returns',
+                                                     stock_returns.period_utils.months)
+
+    # Compare the neighbors for one date against a brute-force search over the values known at that date
+    date = walk_forward.cape_ser.index[800]
+    known = walk_forward.realized[:date - pd.DateOffset(months=120)].dropna()
+    distance = np.abs(walk_forward.cape_ser[known.index] - walk_forward.cape_ser[date])
+    expected = known[distance.sort_values().index[0:20]]
+    assert np.allclose(np.sort(walk_forward.neighbors[800]), np.sort(expected.values))
+
+    predict_df = walk_forward.predict([5, 20], stock_returns.period_utils.annualized_returns, 'returns')
+    assert predict_df.loc[:date, (20, 'returns')].notnull().any()
+    stats = walk_forward.error_stats([5, 20], stock_returns.period_utils.annualized_returns)
+    assert list(stats.index) == [5, 20]
+    assert (stats['count'] > 0).all()
+    assert (stats['rmse'] >= stats['mae']).all()
+
+
+def test_sorted_pool():
+    rng = np.random.RandomState(1)
+    keys = np.round(rng.normal(size=200), 1)
+    pool = analysis.SortedPool(block_size=2)
+    for i, key in enumerate(keys):
+        pool.insert(key, i)
+    assert len(pool) == len(keys)
+    assert sum(pool.keys, []) == sorted(keys)
+    for key in [-5.0, 0.05, 0.1, 5.0]:
+        nearest = pool.nearest(key, 10)
+        distances = np.abs(keys[nearest] - key)
+        assert list(distances) == sorted(np.abs(keys - key))[0:10]
+
+
+def test_nowcast(tmpdir, shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    cape = analysis.Cape(data, summary='median')
+    nominal = data.nominal_data
+    cpi = data.real_stock_data.cpi_s
+    # Start from the history up to the end of 1999 and replay 2000-01 and 2000-02
+    history = data_series.NominalData(nominal.stocks_df.loc[:'1999-12'], nominal.gs10_s.loc[:'1999-12'] * 100)
+    history = data_series.RealStockData(history, cpi.loc[:'1999-12'], data.real_stock_data.base_price_level)
+    jan, feb = nominal.stocks_df.loc['2000-01'].iloc[0], nominal.stocks_df.loc['2000-02'].iloc[0]
+    path = tmpdir.join("ticks.csv")
+    path.write("time,price,earnings,cpi\n"
+               "2000-01-14,{},,\n"
+               "2000-02-01,,{},{}\n"
+               "2000-02-14,{},,\n".format(jan['P'], jan['E'], cpi['2000-01'][0], feb['P']))
+
+    async def collect():
+        cast = nowcast.CapeNowcast(history, summary='median')
+        return [n async for n in cast.stream(nowcast.read_tick_file(str(path)))]
+
+    results = asyncio.run(collect())
+    assert len(results) == 2
+    # Without a CPI for the current month, the nowcast converts prices with the CPI of the latest row
+    assert abs(results[0].cape - cape.df.loc['2000-01', 'cape'][0] * cpi['2000-01'][0] / cpi['1999-12'][0]) < 0.00001
+    assert abs(results[1].cape - cape.df.loc['2000-02', 'cape'][0] * cpi['2000-02'][0] / cpi['2000-01'][0]) < 0.00001
+    assert abs(results[1].warranted_returns - 1 / results[1].cape) < 0.00001
+
+    # The latest rows of the file have a CPI but no earnings. Like Cape, the nowcast counts them as months
+    # without earnings and converts the price with the latest CPI.
+    price = nominal.stocks_df['P'].iloc[-1]
+    for summary in ['mean', 'median']:
+        latest_cape = analysis.Cape(data, summary=summary).df['cape'].iloc[-1]
+        cast = nowcast.CapeNowcast(data.real_stock_data, summary=summary)
+        assert abs(cast.update(nowcast.PriceTick(None, price)).cape - latest_cape) < 0.00001
+
+    # The same from CPI-only rows in the stream
+    last_earnings = nominal.stocks_df['E'].last_valid_index()
+    history = data_series.NominalData(nominal.stocks_df.loc[:last_earnings], nominal.gs10_s.loc[:last_earnings] * 100)
+    history = data_series.RealStockData(history, cpi.loc[:last_earnings], data.real_stock_data.base_price_level)
+    cast = nowcast.CapeNowcast(history)
+    for date, value in cpi.loc[last_earnings:].iloc[1:].items():
+        cast.roll(nowcast.EarningsRow(date, np.nan, value))
+    latest_cape = analysis.Cape(data).df['cape'].iloc[-1]
+    assert abs(cast.update(nowcast.PriceTick(None, price)).cape - latest_cape) < 0.00001
+
+
+def test_percentiles(shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    cape = analysis.Cape(data)
+    cape_ser = cape.df['cape'].dropna()
+    index = percentiles.PercentileIndex.from_cape(cape)
+    assert abs(index.percentile_rank(cape_ser.iloc[-1]) - 100.0 * (cape_ser <= cape_ser.iloc[-1]).mean()) < 0.00001
+    assert np.allclose(index.quantile([0.1, 0.5, 0.9]), np.quantile(cape_ser, [0.1, 0.5, 0.9]))
+
+    # As-of-date queries only see the history up to the date
+    dates = pd.to_datetime(['1950-06-01', '2000-01-01'])
+    ranks = index.percentile_rank_as_of(20.0, dates)
+    quantiles = index.quantile_as_of(0.5, dates)
+    for date, rank, quantile in zip(dates, ranks, quantiles):
+        assert abs(rank - 100.0 * (cape_ser[:date] <= 20.0).mean()) < 0.00001
+        assert abs(quantile - cape_ser[:date].median()) < 0.00001
+    assert np.isnan(index.percentile_rank_as_of(20.0, '1800-01-01'))
+
+    # Returns are only known at the end of their period
+    stock_returns = returns.StockReturns(data)
+    returns_ser = stock_returns.df['returns'].dropna()
+    index = percentiles.PercentileIndex.from_stock_returns(stock_returns)
+    rank = index.percentile_rank_as_of(0.0, '1990-01-01', kind='strict')
+    assert abs(rank - 100.0 * (returns_ser[:'1980-01-01'] < 0.0).mean()) < 0.00001
+    ranks = index.point_in_time_ranks()
+    assert len(ranks) == len(returns_ser)
+
+
+def test_percentiles_as_of_random():
+    rng = np.random.RandomState(3)
+    ser = pd.Series(np.round(rng.normal(size=300), 1), pd.date_range('1900-01-01', periods=300, freq='MS'))
+    index = percentiles.PercentileIndex(ser, lag_months=3)
+    dates = pd.date_range('1899-06-01', periods=320, freq='MS')
+    values = np.round(rng.normal(size=len(dates)), 1)
+    ranks = index.percentile_rank_as_of(values, dates)
+    quantiles = index.quantile_as_of(0.37, dates)
+    for date, value, rank, quantile in zip(dates, values, ranks, quantiles):
+        known = ser[ser.index + pd.DateOffset(months=3) <= date]
+        if len(known) < 1:
+            assert np.isnan(rank) and np.isnan(quantile)
+            continue
+        assert abs(rank - 100.0 * (known <= value).mean()) < 0.00001
+        assert abs(quantile - np.quantile(known, 0.37)) < 0.00001
+
+
+def test_build_constants():
+    # build avoids importing the analysis modules, so it keeps copies of these
+    assert build.HORIZONS == list(ui.UI_HORIZONS)
+    assert [tuple(variant) for variant in build.CAPE_VARIANTS] == list(snapshot.CAPE_VARIANTS)
+    assert build.BOND_MODELS == returns.BOND_MODELS
+    assert 'build' in build.CODE_MODULES
+
+
+def test_build_pipeline(tmpdir, monkeypatch, shiller_excel_data_path):
+    cache_dir = str(tmpdir.join("cache"))
+    output = str(tmpdir.join("ui.json"))
+    snapshot_path = str(tmpdir.join("derived.snap"))
+    lines = []
+    pipeline = build.Pipeline(shiller_excel_data_path, cache_dir, jobs=2, log=lines.append)
+    pipeline.derive()
+    pipeline.export(output, snapshot_path)
+    assert "cape: built" in lines
+    assert "export: wrote {}".format(output) in lines
+    assert 'returns' in pipeline.load('stock_returns')[15]
+
+    # The exports are assembled from the derivations and match computing them from scratch
+    data = reader.read_ie_data(shiller_excel_data_path)
+    with open(output) as f:
+        assert json.load(f) == json.loads(json.dumps(ui.UiData(data).payload()))
+    expected = snapshot.compute_snapshot_df(data)
+    snap = snapshot.read_snapshot(snapshot_path)
+    assert snap.columns == list(expected.columns)
+    assert np.allclose(snap.values, expected.values.T, equal_nan=True)
+
+    # Nothing changed, so nothing is rebuilt
+    lines = []
+    pipeline = build.Pipeline(shiller_excel_data_path, cache_dir, log=lines.append)
+    pipeline.derive()
+    pipeline.export(output, snapshot_path)
+    assert all(line.endswith("unchanged") for line in lines)
+
+    # A change to the code invalidates the cache
+    monkeypatch.setattr(build, 'code_digest', lambda: 'changed')
+    lines = []
+    build.Pipeline(shiller_excel_data_path, cache_dir, jobs=1, log=lines.append).derive(['cape'])
+    assert "ingest: unchanged" not in lines and "cape: built" in lines
+
+
+def test_dsr_figures(tmpdir, shiller_excel_data_path):
+    pytest.importorskip('seaborn')
+    pytest.importorskip('statsmodels')
+    from . import dsr_figures
+    data = reader.read_ie_data(shiller_excel_data_path)
+    out_dir = str(tmpdir.join("figures"))
+    names = ['wr_error_10y', 'gs10_returns']
+    rendered = dsr_figures.build_figures(data, out_dir, names, formats=('png', 'svg'), jobs=2)
+    assert rendered == {'wr_error_10y': True, 'gs10_returns': True}
+    assert tmpdir.join("figures", "gs10_returns.svg").check()
+    # Unchanged inputs are not redrawn
+    rendered = dsr_figures.build_figures(data, out_dir, names, formats=('png', 'svg'), jobs=2)
+    assert rendered == {'wr_error_10y': False, 'gs10_returns': False}
+
+
+def test_dsr_figures_all(tmpdir, shiller_excel_data_path):
+    pytest.importorskip('seaborn')
+    pytest.importorskip('statsmodels')
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from . import dsr_figures
+    data = reader.read_ie_data(shiller_excel_data_path)
+    backend = plt.get_backend()
+    rc_params = dict(matplotlib.rcParams)
+    # Rendering serially leaves the caller's backend and style alone
+    rendered = dsr_figures.build_figures(data, str(tmpdir), jobs=1)
+    assert rendered == {name: True for name in dsr_figures.FIGURES}
+    assert all(tmpdir.join("{}.png".format(name)).check() for name in dsr_figures.FIGURES)
+    assert plt.get_backend() == backend
+    assert dict(matplotlib.rcParams) == rc_params
+
+
+def test_bond_total_returns(tmpdir, shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    duration, convexity = returns.BondTotalReturns.duration_convexity([0.05], 10)
+    assert abs(duration[0] - (1 - np.power(1.05, -10)) / 0.05) < 0.00001
+
+    bonds = returns.BondTotalReturns(data, horizons=[10, 20])
+    for horizon in [10, 20]:
+        hold = returns.BondHoldToMaturityReturns(data, horizon).df
+        total = bonds.horizon_df(horizon)
+        assert total.shape == hold.shape
+        assert list(total.columns) == list(hold.columns)
+        assert (total['gs10_returns'].notnull() == hold['gs10_returns'].notnull()).all()
+    # Compounding the monthly real returns reproduces the 10-year gross return
+    monthly = bonds.monthly_df.loc['2005-05':'2015-04', 'real_return']
+    assert abs(np.prod(1 + monthly) - 1 - bonds.df.loc['2005-05', (10, 'gross_gs10_returns')][0]) < 0.00001
+
+    # The one-pass engine is reachable from the UI data and the build pipeline
+    ui_df = ui.UiData(data, bond_model='total').df
+    assert np.allclose(ui_df['bond_20y'], bonds.df[(20, 'gs10_returns')].values, equal_nan=True)
+    pipeline = build.Pipeline(shiller_excel_data_path, str(tmpdir.join("cache")), jobs=1, bond_model='total')
+    pipeline.derive(['bonds'])
+    assert np.allclose(pipeline.load('bonds')[20]['gs10_returns'], bonds.df[(20, 'gs10_returns')], equal_nan=True)
+    with pytest.raises(ValueError):
+        returns.bond_returns_dfs(data, [10], 'coupon')
+
+
+def test_chunked_pipeline(tmpdir, shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    source = str(tmpdir.join("source"))
+    chunked.write_ie_data_columns(data, source)
+    # Use blocks smaller than the windows to exercise the halos
+    pipeline = chunked.ChunkedPipeline(source, str(tmpdir.join("output")), chunk_size=100)
+    columns = pipeline.run(summary='median', horizons=[10, 20])
+    assert isinstance(columns['cape'], np.memmap)
+
+    df = chunked.read_columns(str(tmpdir.join("output")))
+    assert np.allclose(df['m_return'], data.real_stock_data.df['m_return'], equal_nan=True)
+    assert np.allclose(df['cape'], analysis.Cape(data, summary='median').df['cape'], equal_nan=True)
+    for horizon in [10, 20]:
+        stock_returns = returns.StockReturns(data, horizon).df
+        assert np.allclose(df['stockgross_{}y'.format(horizon)], stock_returns['gross_returns'], equal_nan=True)
+        assert np.allclose(df['stock_{}y'.format(horizon)], stock_returns['returns'], equal_nan=True)
+        inflation = returns.Inflation(data, horizon).df
+        assert np.allclose(df['inflation_{}y'.format(horizon)], inflation['forward_inflation'], equal_nan=True)
+
+
+def test_tuning(shiller_excel_data_path):
+    data = reader.read_ie_data(shiller_excel_data_path)
+    stock_returns = returns.StockReturns(data)
+    tuner = tuning.CapeNeighborsTuner(data, stock_returns, years=[10, 20], neighbor_counts=[5, 20], folds=4,
+                                      transform=stock_returns.period_utils.annualized_returns, jobs=2)
+    results = tuner.fit()
+    assert len(results) == 2 * 2 * 2
+    # Every variant is scored on the same rows
+    assert results['count'].nunique() == 1
+    assert (results['rmse'].diff().dropna() >= 0).all()
+    best = tuner.best_params
+    assert best['neighbors'] in [5, 20]
+    predictor = tuner.best_predictor()
+    assert predictor.max_neighbors == best['neighbors']
+    assert predictor.estimator.cape.years == best['years']
+
+    # Neighbor counts larger than the training rows left after purging are not scored
+    index = pd.date_range('2000-01-01', periods=30, freq='MS')
+    variant = tuning.CapeVariantFolds(pd.Series(np.arange(30.0), index), pd.Series(np.arange(30.0), index), 6,
+                                      np.array_split(np.arange(30), 2))
+    errors = variant.fold_errors(variant.blocks[0], [1, 9, 10])
+    assert np.isfinite(errors[:, 0:2]).all() and np.isnan(errors[:, 2]).all()
+
+
+def test_server(tmpdir, shiller_excel_data_path):
+    ie_data_path = str(tmpdir.join('ie_data.xls'))
+    shutil.copy(shiller_excel_data_path, ie_data_path)
+
+    async def exercise():
+        service = server.UiDataServer(ie_data_path, port=0, poll_interval=0.05)
+        await service.start()
+        try:
+            reader_, writer = await asyncio.open_connection('127.0.0.1', service.port)
+            status, headers, body = await loadtest.fetch(reader_, writer, 'localhost', '/data.json')
+            assert status == 200
+            assert len(json.loads(body.decode('utf-8'))['data_table']) > 1000
+            status, _, _ = await loadtest.fetch(reader_, writer, 'localhost', '/data.json',
+                                                {'If-None-Match': headers['etag']})
+            assert status == 304
+            status, gz_headers, gz_body = await loadtest.fetch(reader_, writer, 'localhost', '/horizons/10.json',
+                                                               {'Accept-Encoding': 'gzip'})
+            assert status == 200 and gz_headers['content-encoding'] == 'gzip'
+            row = json.loads(gzip.decompress(gz_body).decode('utf-8'))[0]
+            assert sorted(row) == ['bond_10y', 'bondgross_10y', 'cape', 'date', 'inflation_10y',
+                                   'stock_10y', 'stockgross_10y']
+            status, _, _ = await loadtest.fetch(reader_, writer, 'localhost', '/missing.json')
+            assert status == 404
+            writer.close()
+
+            # A request body is not parsed as the next request
+            reader_, writer = await asyncio.open_connection('127.0.0.1', service.port)
+            writer.write(b'POST /data.json HTTP/1.1\r\nHost: localhost\r\nContent-Length: 18\r\n\r\n'
+                         b'GET /x HTTP/1.1\r\n\r\n')
+            status, post_headers, _ = await loadtest.fetch(reader_, writer, 'localhost', '/data.json')
+            assert status == 405 and post_headers['connection'] == 'close'
+            assert await reader_.read() == b''
+            writer.close()
+
+            async def wait_for_poll(condition):
+                for _ in range(200):
+                    if condition():
+                        break
+                    await asyncio.sleep(0.05)
+
+            # Touching the source triggers a rebuild; the content, and so the ETag, is unchanged
+            mtime = os.stat(ie_data_path).st_mtime
+            os.utime(ie_data_path, (mtime + 10, mtime + 10))
+            await wait_for_poll(lambda: service.builds > 1)
+            assert service.builds == 2
+            assert service.payloads['/data.json'].etag == headers['etag']
+
+            # An invalid file keeps the current payloads, and the watcher recovers once the file is fixed
+            with open(shiller_excel_data_path, 'rb') as f:
+                content = f.read()
+            with open(ie_data_path, 'wb') as f:
+                f.write(content[0:len(content) // 2])
+            await wait_for_poll(lambda: service.last_error is not None)
+            assert service.last_error is not None
+            assert service.builds == 2 and not service._watcher.done()
+            shutil.copy(shiller_excel_data_path, ie_data_path)
+            await wait_for_poll(lambda: service.builds > 2)
+            assert service.builds == 3 and service.last_error is None
+
+            stats = await loadtest.load_test('http://127.0.0.1:{}/wr_curve.json'.format(service.port), 200, 4)
+            assert stats['requests'] == 200
+        finally:
+            await service.close()
+
+    asyncio.run(exercise())
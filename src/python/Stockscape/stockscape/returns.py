@@ -13,6 +13,8 @@ Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
 import numpy as np
 import pandas as pd
 
+from . import kernels
+
 
 class PeriodUtils(object):
     """Utilities for performing calculations over a period (in years)."""
@@ -25,19 +27,19 @@ class PeriodUtils(object):
     def annualized_returns(self):
         """Return a function that takes gross returns over years and returns annualized returns."""
         years = self.years
-        return np.vectorize(lambda gross_returns: np.power(1 + gross_returns, 1 / years) - 1)
+        return lambda gross_returns: np.power(1 + np.asarray(gross_returns, dtype=np.float64), 1 / years) - 1
 
     @property
     def gross_returns(self):
         """Return a function that takes rates returns over years and returns annualized returns."""
         years = self.years
-        return np.vectorize(lambda rate: np.power(1 + rate, years) - 1)
+        return lambda rate: np.power(1 + np.asarray(rate, dtype=np.float64), years) - 1
 
     @property
     def warranted_returns(self):
         """Return a function that takes a cape as an estimate and returns the warranted returns."""
         years = self.years
-        return np.vectorize(lambda cape: np.power(1 + (1 / cape), years) - 1)
+        return lambda cape: np.power(1 + (1 / np.asarray(cape, dtype=np.float64)), years) - 1
 
 
 class StockReturns(object):
@@ -68,8 +70,9 @@ class StockReturns(object):
         df = real_stock_data.df
 
         months = period_utils.months
-        gross_returns = (1 + df['m_return']).rolling(months, 1).apply(np.prod) - 1
-        gross_returns = gross_returns.shift(-months)
+        # The product of the monthly returns over the following months. Months without a return (e.g., the
+        # latest month, whose dividend is not yet known) are skipped.
+        gross_returns = pd.Series(kernels.forward_product(1 + df['m_return'].values, months), index=df.index) - 1
 
         returns = period_utils.annualized_returns(gross_returns)
 
@@ -139,6 +142,115 @@ class BondHoldToMaturityReturns(object):
         return pd.DataFrame({'gross_gs10_returns': gs10_gross, 'gs10_returns': gs10_returns}, index=gs10_s.index)
 
 
+class BondTotalReturns(object):
+    """Compute the total returns on a rolling portfolio of constant-maturity bonds for many horizons at once.
+
+    Each month the portfolio holds a par bond with the GS10 yield as its coupon. Over the month it earns the
+    coupon and the price change from the change in yield, approximated with the bond's modified duration and
+    convexity. Monthly real returns are compounded to forward returns for every horizon using cumulative sums.
+    """
+
+    def __init__(self, stockscape_data, horizons=range(10, 21), maturity=10):
+        """Initialize the BondTotalReturns object.
+        :param stockscape_data: A data_series.StockscapeData object.
+        :param horizons: The periods over which returns are calculated, specified in years.
+        :param maturity: The maturity of the bonds held, in years. Defaults to 10 years.
+        """
+        self.data = stockscape_data
+        self.horizons = list(horizons)
+        self.maturity = maturity
+        self.monthly_df = self.compute_monthly_df(self.data.nominal_data.gs10_s, self.data.real_stock_data.cpi_s,
+                                                  maturity)
+        self.df = self.compute_df(self.monthly_df['real_return'], self.horizons)
+
+    @staticmethod
+    def duration_convexity(yields, maturity):
+        """Return the modified duration and convexity of par bonds with annual coupons.
+        :param yields: An array of yields, which are also the coupon rates
+        :param maturity: The maturity in years
+        :return: A tuple of arrays (duration, convexity)
+        """
+        y = np.asarray(yields, dtype=np.float64)[:, np.newaxis]
+        k = np.arange(1, maturity + 1, dtype=np.float64)[np.newaxis, :]
+        cash_flows = np.where(k == maturity, 1 + y, y)
+        discount = np.power(1 + y, -k)
+        price = (cash_flows * discount).sum(axis=1)
+        duration = (k * cash_flows * discount).sum(axis=1) / ((1 + y[:, 0]) * price)
+        convexity = (k * (k + 1) * cash_flows * discount).sum(axis=1) / (np.power(1 + y[:, 0], 2) * price)
+        return duration, convexity
+
+    @staticmethod
+    def compute_monthly_df(gs10_s, cpi_s, maturity=10):
+        """Compute a frame with the monthly nominal and real returns of the bond portfolio.
+
+        The return in the row for a month is earned over that month, i.e., until the start of the next month.
+        :param gs10_s: The series with the 10-year T-Bond yield data
+        :param cpi_s: The series with the consumer price index data
+        :param maturity: The maturity of the bonds held, in years
+        :return: A frame containing duration, convexity, nominal_return, and real_return
+        """
+        y = gs10_s.values.astype(np.float64)
+        duration, convexity = BondTotalReturns.duration_convexity(y, maturity)
+        dy = np.append(np.diff(y), np.nan)
+        nominal_return = y / 12 - duration * dy + 0.5 * convexity * np.power(dy, 2)
+        cpi = cpi_s.values.astype(np.float64)
+        price_correction = np.append(cpi[1:] / cpi[:-1], np.nan)
+        real_return = (1 + nominal_return) / price_correction - 1
+        return pd.DataFrame({'duration': duration, 'convexity': convexity, 'nominal_return': nominal_return,
+                             'real_return': real_return}, index=gs10_s.index)
+
+    @staticmethod
+    def compute_df(real_return_s, horizons):
+        """Compute a frame with forward real bond returns (annualized and gross) for all horizons.
+
+        :param real_return_s: The series of monthly real returns
+        :param horizons: The periods over which returns are calculated, specified in years
+        :return: A frame with columns (horizon, gross_gs10_returns) and (horizon, gs10_returns)
+        """
+        log_returns = np.log1p(real_return_s.values)
+        missing = np.isnan(log_returns)
+        # Cumulative sums with a leading zero, so the sum over [t, t + months) is cum[t + months] - cum[t]
+        cum_log = np.concatenate([[0], np.cumsum(np.where(missing, 0, log_returns))])
+        cum_missing = np.concatenate([[0], np.cumsum(missing)])
+        n = len(log_returns)
+        columns = {}
+        for horizon in horizons:
+            months = horizon * 12
+            gross = np.full(n, np.nan)
+            if months <= n:
+                window_log = cum_log[months:] - cum_log[:-months]
+                window_missing = cum_missing[months:] - cum_missing[:-months]
+                gross[0:n - months + 1] = np.where(window_missing > 0, np.nan, np.expm1(window_log))
+            columns[(horizon, 'gross_gs10_returns')] = gross
+            columns[(horizon, 'gs10_returns')] = np.power(1 + gross, 1 / horizon) - 1
+        df = pd.DataFrame(columns, index=real_return_s.index)
+        df.columns.names = ['horizon', 'stat']
+        return df
+
+    def horizon_df(self, horizon):
+        """Return a frame for one horizon with the same columns as BondHoldToMaturityReturns.df."""
+        return self.df[horizon]
+
+
+BOND_MODELS = ['hold_to_maturity', 'total']
+
+
+def bond_returns_dfs(stockscape_data, horizons, model='hold_to_maturity'):
+    """Return a dict of horizon to a frame of real bond returns (gs10_returns and gross_gs10_returns).
+
+    :param stockscape_data: A data_series.StockscapeData object.
+    :param horizons: The periods over which returns are calculated, specified in years.
+    :param model: 'hold_to_maturity' for a BondHoldToMaturityReturns per horizon, or 'total' for the returns
+    of a rolling bond portfolio, computed for all horizons in one pass by BondTotalReturns.
+    """
+    if model == 'hold_to_maturity':
+        return {h: BondHoldToMaturityReturns(stockscape_data, h).df for h in horizons}
+    if model == 'total':
+        total_returns = BondTotalReturns(stockscape_data, horizons)
+        return {h: total_returns.horizon_df(h) for h in horizons}
+    raise ValueError("Unknown bond model {}. Expected one of {}".format(model, BOND_MODELS))
+
+
 class WaitingReturns(object):
     def __init__(self, ie_data, horizons=[10, 15, 20], waits=range(1, 4)):
         """Compute returns over horizons years from waiting waits years."""
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+server.py
+
+A small asyncio HTTP server for the UI data, using only the standard library.
+
+The payloads are computed once at startup and kept as serialized and gzip-compressed bytes, so a
+request is only a dictionary lookup and a write. Responses carry an ETag and requests with a matching
+If-None-Match get a 304. When the ie_data file changes, the payloads are rebuilt in a background
+executor and swapped in at once.
+
+  GET /data.json              The full UI data, as written by UiData.write
+  GET /wr_curve.json          The warranted returns curve
+  GET /horizons/<years>.json  The UI data table restricted to date, cape, and the columns for one horizon
+
+Created by Chandrasekhar Ramakrishnan on 2018-01-08.
+Copyright (c) 2018 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+from collections import namedtuple
+from email.utils import formatdate
+
+Payload = namedtuple('Payload', ['body', 'gzip_body', 'etag', 'gzip_etag'])
+Payload.__doc__ = """A response body, plain and gzip-compressed, with an ETag for each."""
+
+HORIZON_PREFIXES = ['stock', 'stockgross', 'bond', 'bondgross', 'inflation']
+
+MAX_DISCARDED_BODY = 64 * 1024
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def make_payload(obj):
+    """Serialize obj to JSON and return a Payload."""
+    body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[0:20])
+    gzip_body = gzip.compress(body, 6, mtime=0)
+    return Payload(body, gzip_body, etag, etag[:-1] + '-gz"')
+
+
+def build_payloads(ie_data_path):
+    """Read the ie_data file and return a dict of request path to Payload."""
+    from .reader import read_ie_data
+    from .ui import UI_HORIZONS, UiData
+
+    payload = UiData(read_ie_data(ie_data_path)).payload()
+    payloads = {
+        '/data.json': make_payload(payload),
+        '/wr_curve.json': make_payload(payload['wr_curve']),
+    }
+    for horizon in UI_HORIZONS:
+        columns = ['date', 'cape'] + ['{}_{}y'.format(prefix, horizon) for prefix in HORIZON_PREFIXES]
+        table = [{c: row[c] for c in columns} for row in payload['data_table']]
+        payloads['/horizons/{}.json'.format(horizon)] = make_payload(table)
+    return payloads
+
+
+class UiDataServer(object):
+    """Serve precomputed UI data payloads over HTTP/1.1 with keep-alive and conditional requests."""
+
+    def __init__(self, ie_data_path, host='127.0.0.1', port=8080, poll_interval=5.0, log=None):
+        """
+        :param ie_data_path: Path to an ie_data file
+        :param host: The interface to listen on
+        :param port: The port to listen on, 0 to choose a free port
+        :param poll_interval: Seconds between checks for changes to the ie_data file
+        :param log: A function called with a status line for each rebuild. Defaults to doing nothing.
+        """
+        self.ie_data_path = ie_data_path
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.payloads = {}
+        self.builds = 0
+        self.last_error = None
+        self.log = log if log else (lambda line: None)
+        self.server = None
+        self._source_stat = None
+        self._watcher = None
+
+    def _stat(self):
+        st = os.stat(self.ie_data_path)
+        return st.st_mtime_ns, st.st_size
+
+    async def reload(self):
+        """Rebuild the payloads in an executor and swap them in."""
+        source_stat = self._stat()
+        loop = asyncio.get_running_loop()
+        payloads = await loop.run_in_executor(None, build_payloads, self.ie_data_path)
+        # Replacing the dict is atomic for the request handlers
+        self.payloads = payloads
+        self._source_stat = source_stat
+        self.builds += 1
+        self.last_error = None
+
+    async def _watch(self):
+        failed_stat = None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                source_stat = self._stat()
+            except OSError:
+                # The file is being replaced; look again at the next poll
+                continue
+            if source_stat in (self._source_stat, failed_stat):
+                continue
+            try:
+                await self.reload()
+                self.log("rebuilt payloads from {}".format(self.ie_data_path))
+            except Exception as e:
+                # The file may be half-written or invalid. Keep serving the current payloads and try again
+                # once the file changes.
+                failed_stat = source_stat
+                self.last_error = e
+                self.log("could not rebuild payloads from {}: {!r}".format(self.ie_data_path, e))
+
+    async def start(self):
+        """Build the payloads, start listening, and start watching the ie_data file."""
+        await self.reload()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._watcher = asyncio.ensure_future(self._watch())
+
+    async def close(self):
+        self._watcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    def respond(self, method, path, headers):
+        """Return (status, headers, body) for a request."""
+        if method not in ('GET', 'HEAD'):
+            return 405, [('Allow', 'GET, HEAD')], b''
+        payload = self.payloads.get(path.split('?', 1)[0])
+        if payload is None:
+            return 404, [], b''
+        accepts_gzip = 'gzip' in headers.get('accept-encoding', '')
+        etag = payload.gzip_etag if accepts_gzip else payload.etag
+        response_headers = [('ETag', etag), ('Vary', 'Accept-Encoding'), ('Cache-Control', 'no-cache')]
+        if_none_match = headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              etag in [t.strip() for t in if_none_match.split(',')]):
+            return 304, response_headers, b''
+        response_headers.append(('Content-Type', 'application/json'))
+        if accepts_gzip:
+            response_headers.append(('Content-Encoding', 'gzip'))
+            body = payload.gzip_body
+        else:
+            body = payload.body
+        return 200, response_headers, body
+
+    @staticmethod
+    async def _discard_body(reader, headers):
+        """Read and drop a request body, so that it is not parsed as the next request.
+        :return: False if the body could not be discarded and the connection must be closed
+        """
+        if 'transfer-encoding' in headers:
+            return False
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return False
+        if length < 0 or length > MAX_DISCARDED_BODY:
+            return False
+        try:
+            await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return False
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    status, response_headers, body = 400, [], b''
+                    content_length, keep_alive = 0, False
+                else:
+                    method, path, version = parts
+                    status, response_headers, body = self.respond(method, path, headers)
+                    content_length = len(body)
+                    if method == 'HEAD':
+                        body = b''
+                    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                    if method not in ('GET', 'HEAD') or not await self._discard_body(reader, headers):
+                        keep_alive = False
+                out = ['HTTP/1.1 {} {}'.format(status, REASONS[status]),
+                       'Date: {}'.format(formatdate(usegmt=True)),
+                       'Content-Length: {}'.format(content_length),
+                       'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+                out.extend('{}: {}'.format(name, value) for name, value in response_headers)
+                writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+
+def serve(ie_data_path, host='127.0.0.1', port=8080, poll_interval=5.0, log=None):
+    """Run a UiDataServer until interrupted."""
+    server = UiDataServer(ie_data_path, host, port, poll_interval, log)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
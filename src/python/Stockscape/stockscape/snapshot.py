@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+snapshot.py
+
+Write all derived series into a single binary snapshot file that can be memory-mapped read-only.
+
+Many processes that map the same snapshot share its pages through the OS page cache, so the
+derived data is held once per host instead of once per process.
+
+The file layout is:
+
+  - an 8-byte magic string, a uint32 format version, a uint32 (reserved), and a uint64 header length
+  - a JSON header describing the columns, the number of rows, and the offsets of the arrays
+  - the index as int64 nanoseconds since the epoch, aligned to SNAPSHOT_ALIGNMENT
+  - the data as a float64 (columns x rows) array, aligned to SNAPSHOT_ALIGNMENT, so each column is contiguous
+
+Reading a snapshot only needs numpy and pandas; the modules that compute the series are imported
+when a snapshot is written, so processes that only map snapshots start quickly.
+
+Created by Chandrasekhar Ramakrishnan on 2017-11-06.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+import argparse
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_MAGIC = b'STKSNAP\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 4096
+_PREAMBLE = struct.Struct('<8sIIQ')
+
+CAPE_VARIANTS = [(years, summary) for years in (5, 10, 15, 20) for summary in ('mean', 'median')]
+
+
+def cape_variant_column(years, summary):
+    """Return the snapshot column name for a CAPE computed over years with the summary statistic."""
+    return 'cape_{}_{}y'.format(summary, years)
+
+
+def compute_snapshot_df(stockscape_data, horizons=None, cape_variants=CAPE_VARIANTS):
+    """Return a frame, indexed by date, with every series stored in a snapshot.
+
+    The columns are those of UiData.compute_columns plus one column per CAPE variant.
+    :param stockscape_data: The data used to create the frame
+    :param horizons: The horizons (in years) to compute returns and inflation for, defaults to ui.UI_HORIZONS
+    :param cape_variants: A list of (years, summary) tuples describing CAPE variants
+    :return: A data frame of float64 columns
+    """
+    from .analysis import Cape
+    from .ui import UI_HORIZONS, UiData
+
+    columns = UiData.compute_columns(stockscape_data, UI_HORIZONS if horizons is None else horizons)
+    cape_dfs = {(years, summary): Cape(stockscape_data, years, summary).df for years, summary in cape_variants}
+    return snapshot_df_from_frames(columns, cape_dfs)
+
+
+def snapshot_df_from_frames(columns, cape_dfs):
+    """Return the frame stored in a snapshot from already computed series, e.g., those cached by build.Pipeline.
+
+    :param columns: A dict of UI column name to series (see UiData.compute_columns)
+    :param cape_dfs: A dict of (years, summary) to the frame of the Cape computed with them
+    :return: A data frame of float64 columns
+    """
+    columns = dict(columns)
+    for (years, summary), cape_df in cape_dfs.items():
+        columns[cape_variant_column(years, summary)] = cape_df['cape']
+    return pd.DataFrame(columns).astype(np.float64)
+
+
+def _align(offset):
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def write_snapshot_df(df, path):
+    """Write the frame to path as a snapshot.
+
+    The file is written to a temporary file and moved into place, so processes that have the
+    previous version mapped continue to see consistent data.
+    :param df: A frame indexed by date with float columns
+    :param path: The path to write to
+    """
+    columns = [str(c) for c in df.columns]
+    nrows = len(df.index)
+    header = {'version': SNAPSHOT_VERSION, 'nrows': nrows, 'columns': columns, 'dtype': '<f8'}
+    # The offsets depend on the header length, which depends on the offsets, so reserve room for them.
+    header.update({'index_offset': 0, 'data_offset': 0})
+    header_len = len(json.dumps(header).encode('utf-8')) + 64
+    header['index_offset'] = _align(_PREAMBLE.size + header_len)
+    header['data_offset'] = _align(header['index_offset'] + nrows * 8)
+    header_bytes = json.dumps(header).encode('utf-8').ljust(header_len)
+
+    index = pd.DatetimeIndex(df.index).values.astype('<i8')
+    data = np.ascontiguousarray(df.values.T, dtype='<f8')
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, header_len))
+            f.write(header_bytes)
+            f.seek(header['index_offset'])
+            f.write(index.tobytes())
+            f.seek(header['data_offset'])
+            f.write(data.tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_snapshot(stockscape_data, path, horizons=None, cape_variants=CAPE_VARIANTS):
+    """Compute the derived series and write them to path as a snapshot.
+
+    :param stockscape_data: The data used to compute the series
+    :param path: The path to write to
+    :param horizons: The horizons (in years) to compute returns and inflation for, defaults to ui.UI_HORIZONS
+    :param cape_variants: A list of (years, summary) tuples describing CAPE variants
+    """
+    write_snapshot_df(compute_snapshot_df(stockscape_data, horizons, cape_variants), path)
+
+
+class Snapshot(object):
+    """A read-only, memory-mapped view on a snapshot file."""
+
+    def __init__(self, path):
+        """
+        :param path: Path to a file written by write_snapshot
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, _, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError("{} is not a stockscape snapshot".format(path))
+            if version != SNAPSHOT_VERSION:
+                raise ValueError("Snapshot {} has version {}, expected {}".format(path, version, SNAPSHOT_VERSION))
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.columns = self.header['columns']
+        self._column_positions = {c: i for i, c in enumerate(self.columns)}
+        nrows = self.header['nrows']
+        self.index_values = np.memmap(path, dtype='<i8', mode='r', offset=self.header['index_offset'],
+                                      shape=(nrows,))
+        self.values = np.memmap(path, dtype=self.header['dtype'], mode='r', offset=self.header['data_offset'],
+                                shape=(len(self.columns), nrows))
+        self.index = pd.DatetimeIndex(self.index_values.view('datetime64[ns]'))
+
+    def __contains__(self, column):
+        return column in self._column_positions
+
+    def __getitem__(self, column):
+        """Return the column as a series backed by the mapped file."""
+        return pd.Series(self.values[self._column_positions[column]], index=self.index, name=column, copy=False)
+
+    @property
+    def df(self):
+        """Return a frame with all columns. This copies the data out of the mapped file."""
+        return pd.DataFrame(self.values.T, index=self.index, columns=self.columns)
+
+
+def read_snapshot(path):
+    """Map the snapshot at path read-only.
+    :param path: Path to a file written by write_snapshot
+    :return: A Snapshot object
+    """
+    return Snapshot(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the derived series into a memory-mappable snapshot.")
+    parser.add_argument('ie_data', help="Path to an ie_data file")
+    parser.add_argument('output', help="Path to write the snapshot to")
+    args = parser.parse_args(argv)
+    from .reader import read_ie_data
+    write_snapshot(read_ie_data(args.ie_data), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+tuning.py
+
+Choose the CAPE window, the CAPE summary statistic, and the number of neighbors for CAPE-neighbor
+predictions by time-blocked cross-validation.
+
+Created by Chandrasekhar Ramakrishnan on 2017-12-27.
+Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import kernels
+from .analysis import Cape, CapeNeighborsEstimator
+
+
+class CapeVariantFolds(object):
+    """The neighbor ordering for one CAPE variant, shared by all folds and neighbor counts."""
+
+    def __init__(self, cape_ser, target, months, blocks):
+        """
+        :param cape_ser: The CAPE series for the variant, without missing values
+        :param target: The values to predict, indexed like cape_ser, without missing values
+        :param months: The number of rows over which a target value is realized; used to purge the training
+                       rows whose period overlaps the test block
+        :param blocks: A list of arrays of contiguous positions, each one a test block
+        """
+        self.capes = cape_ser.values
+        self.values = target.values
+        # All rows ordered by distance in CAPE, computed once for the variant
+        self.order = kernels.smallest_k(np.abs(np.subtract.outer(self.capes, self.capes)), len(self.capes))
+        self.months = months
+        self.blocks = blocks
+
+    def training_mask(self, block):
+        """Return a mask of rows usable for training when testing on block."""
+        mask = np.ones(len(self.capes), dtype=bool)
+        mask[max(0, block[0] - self.months):block[-1] + self.months + 1] = False
+        return mask
+
+    def fold_errors(self, block, neighbor_counts, transform=None):
+        """Return an array (len(block) x len(neighbor_counts)) of prediction errors (predicted - actual).
+
+        The errors are nan for neighbor counts larger than the number of training rows left after purging.
+        """
+        train = self.training_mask(block)
+        neighbor_counts = np.asarray(neighbor_counts)
+        max_neighbors = min(neighbor_counts.max(), train.sum())
+        errors = np.full((len(block), len(neighbor_counts)), np.nan)
+        usable = neighbor_counts <= max_neighbors
+        if not usable.any():
+            return errors
+        order = self.order[block]
+        # The positions, within each row's ordering, of the nearest max_neighbors training rows
+        positions = np.argsort(~train[order], axis=1, kind='mergesort')[:, 0:max_neighbors]
+        neighbors = self.values[np.take_along_axis(order, positions, axis=1)]
+        means = np.cumsum(neighbors, axis=1) / np.arange(1, max_neighbors + 1)
+        predicted = means[:, neighbor_counts[usable] - 1]
+        actual = self.values[block][:, np.newaxis]
+        if transform:
+            predicted, actual = transform(predicted), transform(actual)
+        errors[:, usable] = predicted - actual
+        return errors
+
+
+class CapeNeighborsTuner(object):
+    """Select CAPE years, summary, and number of neighbors by time-blocked cross-validation."""
+
+    def __init__(self, stockscape_data, stock_returns, years=(5, 10, 15, 20), summaries=('mean', 'median'),
+                 neighbor_counts=range(5, 41, 5), folds=5, column='gross_returns', transform=None, jobs=None):
+        """
+        :param stockscape_data: A data_series.StockscapeData object.
+        :param stock_returns: A returns.StockReturns object with the values to predict.
+        :param years: The CAPE windows, in years, to try
+        :param summaries: The CAPE summary statistics to try
+        :param neighbor_counts: The numbers of neighbors to try
+        :param folds: The number of contiguous blocks of dates used as test sets
+        :param column: The column of stock_returns.df to predict
+        :param transform: An optional transform applied to predictions and actual values before scoring them,
+                          e.g., stock_returns.period_utils.annualized_returns
+        :param jobs: The maximum number of folds evaluated concurrently
+        """
+        self.data = stockscape_data
+        self.stock_returns = stock_returns
+        self.years = list(years)
+        self.summaries = list(summaries)
+        self.neighbor_counts = list(neighbor_counts)
+        self.folds = folds
+        self.column = column
+        self.transform = transform
+        self.jobs = jobs
+        self.results_df = None
+
+    def fit(self):
+        """Run the cross-validation and return a frame of the parameters, ranked by rmse."""
+        target = self.stock_returns.df[self.column]
+        months = self.stock_returns.period_utils.months
+        capes = {(years, summary): Cape(self.data, years, summary).df['cape']
+                 for years in self.years for summary in self.summaries}
+        # Score every variant on the same rows and folds: those with a target and a value for every variant
+        known = pd.concat([target] + list(capes.values()), axis=1, join='inner').dropna().index
+        blocks = np.array_split(np.arange(len(known)), self.folds)
+        rows = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for years in self.years:
+                for summary in self.summaries:
+                    variant = CapeVariantFolds(capes[(years, summary)].loc[known], target.loc[known], months,
+                                               blocks)
+                    errors = np.concatenate(list(executor.map(
+                        lambda block: variant.fold_errors(block, self.neighbor_counts, self.transform),
+                        variant.blocks)))
+                    for i, neighbors in enumerate(self.neighbor_counts):
+                        error = errors[:, i]
+                        rows.append([years, summary, neighbors, len(error), error.mean(), np.abs(error).mean(),
+                                     np.sqrt(np.power(error, 2).mean())])
+        df = pd.DataFrame(rows, columns=['years', 'summary', 'neighbors', 'count', 'mean_error', 'mae', 'rmse'])
+        self.results_df = df.sort_values(['rmse', 'mae']).reset_index(drop=True)
+        return self.results_df
+
+    @property
+    def best_params(self):
+        """Return a dict with the years, summary, and neighbors of the best-scoring parameters."""
+        if self.results_df is None:
+            self.fit()
+        best = self.results_df.iloc[0]
+        return {'years': int(best['years']), 'summary': best['summary'], 'neighbors': int(best['neighbors'])}
+
+    def best_predictor(self):
+        """Return a CapeNeighborsPredictor fit with the best-scoring parameters."""
+        params = self.best_params
+        cape = Cape(self.data, params['years'], params['summary'])
+        return CapeNeighborsEstimator(cape).fit(self.stock_returns.df, self.column, params['neighbors'])
@@ -12,59 +12,123 @@ Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
 
 import json
 
+import numpy as np
 import pandas as pd
 
-from .analysis import Cape, WarrantedReturns
-from .returns import StockReturns, BondHoldToMaturityReturns, Inflation
+from .analysis import Cape
+from .returns import PeriodUtils, StockReturns, BondHoldToMaturityReturns, Inflation, bond_returns_dfs
+
+UI_HORIZONS = range(10, 21)
 
 
 class UiData(object):
     """Convert the data to data for the UI."""
 
-    def __init__(self, stockscape_data):
+    def __init__(self, stockscape_data, df=None, wr=None, bond_model='hold_to_maturity'):
+        """
+        :param stockscape_data: The data used to create the UI data. May be None if df and wr are given.
+        :param df: The UI frame (see compute_df). Computed from stockscape_data if None.
+        :param wr: The warranted returns curve (see compute_wr). Computed from stockscape_data if None.
+        :param bond_model: How bond returns are computed if df is None (see returns.bond_returns_dfs)
+        """
         self.stockscape_data = stockscape_data
-        self.df = self.compute_df(self.stockscape_data)
-        self.wr = self.compute_wr(self.stockscape_data)
+        self.df = df if df is not None else self.compute_df(self.stockscape_data, bond_model)
+        self.wr = wr if wr is not None else self.compute_wr(self.stockscape_data)
+
+    @classmethod
+    def from_frames(cls, cape_df, stock_dfs, bond_dfs, inflation_dfs):
+        """Create the UI data from already computed frames, e.g., those cached by build.Pipeline.
+
+        :param cape_df: The frame of a 10-year mean Cape
+        :param stock_dfs: A dict of horizon to the frame of a StockReturns over that horizon
+        :param bond_dfs: A dict of horizon to a frame of bond returns over that horizon (see returns.bond_returns_dfs)
+        :param inflation_dfs: A dict of horizon to the frame of an Inflation over that horizon
+        :return: A UiData object without stockscape_data
+        """
+        columns = UiData.columns_from_frames(cape_df, stock_dfs, bond_dfs, inflation_dfs)
+        return cls(None, UiData.df_from_columns(columns), UiData.wr_curve(cape_df['cape']))
 
     def write(self, path):
-        df_array = json.loads(self.df.to_json(orient='records'))
         with open(path, 'w') as f:
-            json.dump({'data_table': df_array, 'wr_curve': self.wr}, f)
+            json.dump(self.payload(), f)
+
+    def payload(self):
+        """Return the JSON-serializable dict that is written for the UI."""
+        df_array = json.loads(self.df.to_json(orient='records'))
+        return {'data_table': df_array, 'wr_curve': self.wr}
 
     @staticmethod
-    def compute_df(stockscape_data):
+    def compute_df(stockscape_data, bond_model='hold_to_maturity'):
         """Return a data frame that can be used by the UI
 
         :param stockscape_data: The data used to create the frame
+        :param bond_model: How bond returns are computed (see returns.bond_returns_dfs)
         :return: A data frame
         """
-        columns = {}
-        columns['cape'] = Cape(stockscape_data).df['cape']
-        for horizon in range(10, 21):
-            augment_horizon_data(columns, stockscape_data, horizon)
+        return UiData.df_from_columns(UiData.compute_columns(stockscape_data, bond_model=bond_model))
+
+    @staticmethod
+    def df_from_columns(columns):
+        """Return the UI frame for a dict of column name to series (see compute_columns)."""
         df = pd.DataFrame(columns)
         df['date'] = ["{}-{:02d}".format(d.year, d.month) for d in df.index]
         df = df.reset_index(drop=True)
         return df
 
+    @staticmethod
+    def compute_columns(stockscape_data, horizons=UI_HORIZONS, bond_model='hold_to_maturity'):
+        """Return a dict of the series, keyed by column name, that make up the UI frame.
+
+        :param stockscape_data: The data used to create the columns
+        :param horizons: The horizons (in years) to compute returns and inflation for
+        :param bond_model: How bond returns are computed (see returns.bond_returns_dfs)
+        :return: A dict of column name to series
+        """
+        return UiData.columns_from_frames(Cape(stockscape_data).df,
+                                          {h: StockReturns(stockscape_data, h).df for h in horizons},
+                                          bond_returns_dfs(stockscape_data, horizons, bond_model),
+                                          {h: Inflation(stockscape_data, h).df for h in horizons})
+
+    @staticmethod
+    def columns_from_frames(cape_df, stock_dfs, bond_dfs, inflation_dfs):
+        """Return the dict of UI columns (see compute_columns) from already computed frames (see from_frames)."""
+        columns = {}
+        columns['cape'] = cape_df['cape']
+        for horizon in sorted(stock_dfs):
+            augment_horizon_frames(columns, horizon, stock_dfs[horizon], bond_dfs[horizon], inflation_dfs[horizon])
+        return columns
+
     @staticmethod
     def compute_wr(stockscape_data):
         """Return the warranted returns curve for use by the UI.
 
         :param stockscape_data: The data used to create the frame
-        :return: A data frame
+        :return: A list of dicts with cape and wr
         """
-        wr_10y = WarrantedReturns(Cape(stockscape_data), StockReturns(stockscape_data))
-        return [{'cape': c, 'wr': wr} for c, wr in zip(*wr_10y.warranted_returns_curve())]
+        return UiData.wr_curve(Cape(stockscape_data).df['cape'])
+
+    @staticmethod
+    def wr_curve(cape_ser, years=10):
+        """Return the warranted returns curve over the range of cape_ser (see WarrantedReturns.warranted_returns_curve).
+
+        :param cape_ser: The CAPE series
+        :param years: The period, in years, of the returns
+        :return: A list of dicts with cape and wr
+        """
+        period_utils = PeriodUtils(years)
+        cape_range = np.linspace(cape_ser.min(), cape_ser.max())
+        wr = period_utils.annualized_returns(period_utils.warranted_returns(cape_range))
+        return [{'cape': c, 'wr': r} for c, r in zip(cape_range, wr)]
 
 
 def augment_horizon_data(columns, ie_data, horizon):
-    stocks = StockReturns(ie_data, horizon)
-    bond = BondHoldToMaturityReturns(ie_data, horizon)
-    inflation = Inflation(ie_data, horizon)
-
-    columns['stock_{}y'.format(horizon)] = stocks.df['returns']
-    columns['stockgross_{}y'.format(horizon)] = stocks.df['gross_returns']
-    columns['bond_{}y'.format(horizon)] = bond.df['gs10_returns']
-    columns['bondgross_{}y'.format(horizon)] = bond.df['gross_gs10_returns']
-    columns['inflation_{}y'.format(horizon)] = inflation.df['forward_inflation']
+    augment_horizon_frames(columns, horizon, StockReturns(ie_data, horizon).df,
+                           BondHoldToMaturityReturns(ie_data, horizon).df, Inflation(ie_data, horizon).df)
+
+
+def augment_horizon_frames(columns, horizon, stocks_df, bond_df, inflation_df):
+    columns['stock_{}y'.format(horizon)] = stocks_df['returns']
+    columns['stockgross_{}y'.format(horizon)] = stocks_df['gross_returns']
+    columns['bond_{}y'.format(horizon)] = bond_df['gs10_returns']
+    columns['bondgross_{}y'.format(horizon)] = bond_df['gross_gs10_returns']
+    columns['inflation_{}y'.format(horizon)] = inflation_df['forward_inflation']